@@ -0,0 +1,139 @@
+import statistics
+import optparse
+import time
+import sys
+
+import cv2
+
+from benchmarks.common import RESOLUTIONS, make_jpeg, save_results, \
+    compare_results
+from src.ImageProcessor import ImageProcessor, LOCAL_METRICS
+
+
+# This script times the OpenCV side of ImageProcessor on synthetic images at
+# several resolutions. For every resolution it reports the median time of:
+#
+#   decode            decoding the JPEG bytes
+#   intermediates     each FeatureEngine intermediate (gray, HSV, etc.), given
+#                     the ones it is built from
+#   metrics           each metric of LOCAL_METRICS, given its intermediates
+#   local_metrics     everything above together, as the pipeline runs it
+#
+# Run it from the repository root:
+#
+#   python -m benchmarks.bench_metrics -o metrics.json
+#   python -m benchmarks.bench_metrics --compare metrics.json
+#
+# '--compare' prints the change against the results of an earlier run and
+# exits with status 1 if anything is slower by more than '--threshold'.
+def setup_parser():
+    tmp_parser = optparse.OptionParser()
+    tmp_parser.add_option("-r", "--repeats", dest="repeats", type="int",
+                          help="times each measurement is repeated")
+    tmp_parser.add_option("--resolution", dest="resolutions", action="append",
+                          type="string", help="WIDTHxHEIGHT to run at (may "
+                                              "be given more than once)")
+    tmp_parser.add_option("-s", "--proxy_scale", dest="proxy_scale",
+                          type="int", help="proxy scale used by "
+                                           "local_metrics (1, 2, 4 or 8)")
+    tmp_parser.add_option("-o", "--output", dest="output", type="string",
+                          help="JSON file to store the results in")
+    tmp_parser.add_option("-c", "--compare", dest="compare", type="string",
+                          help="JSON file of an earlier run to compare with")
+    tmp_parser.add_option("-t", "--threshold", dest="threshold",
+                          type="float", help="slowdown reported as a "
+                                             "regression")
+    tmp_parser.set_defaults(repeats=5, resolutions=None, proxy_scale=1,
+                            output=None, compare=None, threshold=0.1)
+
+    return tmp_parser.parse_args()
+
+
+# Median and minimum time of 'repeats' calls of 'function'. 'prepare' is
+# called before each one, untimed, and its result passed to 'function'.
+def measure(function, repeats, prepare=lambda: None):
+    times = []
+    for _ in range(repeats):
+        argument = prepare()
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times), min(times)
+
+
+# Engine of a new ImageProcessor for 'data' with the intermediates in 'warm'
+# already computed
+def warm_engine(data, warm):
+    engine = ImageProcessor("synthetic.jpg", data=data).engine
+    for intermediate in warm:
+        engine.get(intermediate)
+
+    return engine
+
+
+def benchmark_resolution(width, height, repeats, proxy_scale):
+    data = make_jpeg(width, height)
+    processor = ImageProcessor("synthetic.jpg", data=data)
+    resolution = "{}x{}".format(width, height)
+    measurements = []
+
+    measurements.append(('decode', 'decode', measure(
+        lambda _: processor.decode(cv2.IMREAD_COLOR), repeats)))
+
+    # What each intermediate is built from
+    inputs = {'bgr_float': ('bgr',), 'gray': ('bgr',), 'hsv': ('bgr',),
+              'edges': ('bgr', 'gray')}
+    for intermediate, warm in inputs.items():
+        measurements.append(('intermediate', intermediate, measure(
+            lambda engine: engine.get(intermediate), repeats,
+            lambda: warm_engine(data, ('bgr',) + warm))))
+
+    for name, method, requires, proxy in LOCAL_METRICS:
+        measurements.append(('metric', name, measure(
+            lambda engine: getattr(processor, method)(engine), repeats,
+            lambda: warm_engine(data, ('bgr',) + requires))))
+
+    # The whole of the OpenCV work of one image
+    total = 'local_metrics'
+    if proxy_scale != 1:
+        total += '_proxy{}'.format(proxy_scale)
+
+    def local_metrics(_):
+        ImageProcessor("synthetic.jpg", data=data,
+                       proxy_scale=proxy_scale).local_metrics()
+    measurements.append(('total', total, measure(local_metrics, repeats)))
+
+    results = []
+    for kind, name, (median, minimum) in measurements:
+        results.append({'key': "{}/{}/{}".format(kind, name, resolution),
+                        'kind': kind, 'name': name, 'resolution': resolution,
+                        'seconds': median, 'min_seconds': minimum,
+                        'repeats': repeats})
+
+    return results
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+
+    resolutions = RESOLUTIONS
+    if opts.resolutions:
+        resolutions = [tuple(int(side) for side in value.split("x"))
+                       for value in opts.resolutions]
+
+    results = []
+    for width, height in resolutions:
+        print("{}x{}".format(width, height))
+        for result in benchmark_resolution(width, height, opts.repeats,
+                                           opts.proxy_scale):
+            print("  {:<14} {:<15} {:9.2f} ms".format(
+                result['kind'], result['name'], result['seconds'] * 1000))
+            results.append(result)
+
+    if opts.output:
+        save_results(opts.output, 'metrics', results)
+    if opts.compare:
+        if compare_results(opts.compare, results, 'seconds',
+                           threshold=opts.threshold):
+            sys.exit(1)
@@ -0,0 +1,142 @@
+import subprocess
+import tempfile
+import optparse
+import shlex
+import time
+import sys
+import os
+
+from benchmarks.common import StubServer, make_dataset, save_results, \
+    compare_results
+
+
+# main.py settings run when no '--config' is given
+CONFIGS = ['-n 1', '-n 8', '-w 2 -n 8']
+
+# Root of the repository, where main.py is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# This script runs the whole of main.py on a synthetic data set, with the
+# Google and Azure endpoints replaced by a local stub server that answers
+# after a fixed latency. For each main.py configuration it reports the
+# throughput in images per second and the peak resident memory of the run
+# (the largest of main.py and its worker processes). The time includes the
+# start-up of main.py, so use enough images for it not to dominate.
+#
+# Run it from the repository root:
+#
+#   python -m benchmarks.bench_pipeline -o pipeline.json
+#   python -m benchmarks.bench_pipeline --compare pipeline.json
+#
+# '--compare' prints the change against the results of an earlier run and
+# exits with status 1 if the throughput drops, or the memory grows, by more
+# than '--threshold'.
+#
+# With '--throttle N' the stub server answers every N-th request with '429
+# Too Many Requests', to measure the cost of the retries.
+def setup_parser():
+    tmp_parser = optparse.OptionParser()
+    tmp_parser.add_option("-n", "--images", dest="images", type="int",
+                          help="number of synthetic images")
+    tmp_parser.add_option("--resolution", dest="resolution", type="string",
+                          help="WIDTHxHEIGHT of the synthetic images")
+    tmp_parser.add_option("-l", "--latency", dest="latency", type="float",
+                          help="seconds the stub server takes per request")
+    tmp_parser.add_option("--throttle", dest="throttle", type="int",
+                          help="answer every N-th request with a 429")
+    tmp_parser.add_option("--retry_after", dest="retry_after", type="float",
+                          help="Retry-After seconds of the 429 answers")
+    tmp_parser.add_option("--config", dest="configs", action="append",
+                          type="string", help="main.py arguments to "
+                                              "benchmark (may be given more "
+                                              "than once)")
+    tmp_parser.add_option("-o", "--output", dest="output", type="string",
+                          help="JSON file to store the results in")
+    tmp_parser.add_option("-c", "--compare", dest="compare", type="string",
+                          help="JSON file of an earlier run to compare with")
+    tmp_parser.add_option("-t", "--threshold", dest="threshold",
+                          type="float", help="change reported as a "
+                                             "regression")
+    tmp_parser.add_option("-v", "--verbose", dest="verbose",
+                          action="store_true", help="show main.py's output")
+    tmp_parser.set_defaults(images=50, resolution="1280x960", latency=0.05,
+                            throttle=0, retry_after=0.1, configs=None,
+                            output=None, compare=None, threshold=0.1,
+                            verbose=False)
+
+    return tmp_parser.parse_args()
+
+
+# Run main.py with 'config' on the data set in 'directory'. Returns the
+# seconds it took and its peak resident memory in MB.
+def run_main(directory, config, stub_url, verbose):
+    details, labels, image_dir = (os.path.join(directory, name) for name in
+                                  ("details.csv", "labels.csv", "images"))
+    output = tempfile.mkdtemp(dir=directory)
+    command = [sys.executable, "-m", "benchmarks.stubbed_main",
+               "-d", details, "-l", labels, "-i", image_dir,
+               "-a", os.path.join(output, "details"),
+               "-b", os.path.join(output, "images"),
+               "-u", stub_url] + shlex.split(config)
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT,
+                               env=dict(os.environ, BENCH_STUB_URL=stub_url),
+                               stdout=None if verbose else subprocess.DEVNULL)
+    # The resource usage of this process only, including the worker
+    # processes it has waited for
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = -1
+    if os.WIFEXITED(status):
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        raise RuntimeError("main.py failed with '{}'".format(config))
+
+    peak = usage.ru_maxrss / 1024
+    if sys.platform == 'darwin':
+        peak /= 1024
+
+    return seconds, peak
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+    width, height = (int(side) for side in opts.resolution.split("x"))
+    configs = opts.configs or CONFIGS
+
+    server = StubServer(latency=opts.latency, throttle_every=opts.throttle,
+                        retry_after=opts.retry_after).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            make_dataset(directory, opts.images, width, height)
+            for config in configs:
+                seconds, peak = run_main(directory, config, server.url,
+                                         opts.verbose)
+                results.append({
+                    'key': "pipeline/{}/{}/{}".format(
+                        config, opts.resolution, opts.images),
+                    'config': config, 'resolution': opts.resolution,
+                    'images': opts.images, 'latency': opts.latency,
+                    'throttle': opts.throttle,
+                    'seconds': seconds,
+                    'images_per_second': opts.images / seconds,
+                    'peak_rss_mb': peak})
+                print("{:<20} {:8.2f} images/sec {:8.0f} MB peak RSS".format(
+                    config, opts.images / seconds, peak))
+    finally:
+        server.stop()
+
+    if opts.output:
+        save_results(opts.output, 'pipeline', results)
+    if opts.compare:
+        regressions = compare_results(opts.compare, results,
+                                      'images_per_second',
+                                      higher_is_better=True,
+                                      threshold=opts.threshold)
+        regressions += compare_results(opts.compare, results, 'peak_rss_mb',
+                                       threshold=opts.threshold)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,255 @@
+import http.server
+import socketserver
+import threading
+import platform
+import datetime
+import json
+import time
+import os
+
+import cv2
+import numpy as np
+
+
+# Resolutions (width, height) the benchmarks generate images at
+RESOLUTIONS = [(640, 480), (1280, 960), (2048, 1536), (4000, 3000)]
+
+
+# Return a synthetic photo-like BGR image: smooth colour gradients, a few
+# solid shapes and lines, and some noise, so every metric has something to
+# measure (edges for the line count, flat areas for smoothness, etc.).
+def make_image(width, height, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[:, :, 0] = 255 * x * (1 - y)
+    image[:, :, 1] = 255 * y
+    image[:, :, 2] = 255 * (1 - x) * y + 60
+    image += rng.normal(0, 8, image.shape).astype(np.float32)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+
+    for _ in range(6):
+        colour = tuple(int(value) for value in rng.randint(0, 256, 3))
+        centre = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        cv2.circle(image, centre, int(rng.randint(10, height // 4 + 11)),
+                   colour, -1)
+        end = (int(rng.randint(0, width)), int(rng.randint(0, height)))
+        cv2.line(image, centre, end, colour, max(1, width // 400))
+
+    return image
+
+
+# JPEG-encoded bytes of 'make_image()'
+def make_jpeg(width, height, seed=0):
+    ok, encoded = cv2.imencode(".jpg", make_image(width, height, seed))
+
+    return encoded.tobytes()
+
+
+# Write a data set in the layout main.py reads to 'directory': 'images/'
+# holding 'count' JPEG images, 'details.csv' and 'labels.csv'. Returns the
+# paths of (details, labels, images).
+def make_dataset(directory, count, width, height):
+    image_dir = os.path.join(directory, "images")
+    os.makedirs(image_dir, exist_ok=True)
+
+    short_codes = ["B{:09d}".format(index) for index in range(count)]
+    for index, short_code in enumerate(short_codes):
+        with open(os.path.join(image_dir, short_code + ".jpg"), 'wb') as image:
+            image.write(make_jpeg(width, height, seed=index))
+
+    details = os.path.join(directory, "details.csv")
+    with open(details, 'w') as details_file:
+        details_file.write("shortcode,edge_liked_by_count,user_followers,"
+                           "user_posts,user_following\n")
+        for index, short_code in enumerate(short_codes):
+            details_file.write("{}',{},{},{},{}\n".format(
+                short_code, index, 1000 + index, 50, 200))
+
+    labels = os.path.join(directory, "labels.csv")
+    with open(labels, 'w') as labels_file:
+        labels_file.write(",".join(code + ".jpg" for code in short_codes))
+        labels_file.write("\n")
+        labels_file.write(",".join("0.1" for _ in short_codes))
+        labels_file.write("\n")
+
+    return details, labels, image_dir
+
+
+# Handles requests for the stub API server. Every request waits 'latency'
+# seconds, like a round trip to the real service, then returns a fixed
+# answer in the format of the real API.
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+
+    # Every 'throttle_every'-th request (none if 0) is answered '429 Too
+    # Many Requests' with a Retry-After of 'retry_after' seconds
+    throttle_every = 0
+    retry_after = 1
+    requests = None
+
+    def throttled(self):
+        if not self.throttle_every:
+            return False
+        with self.requests['lock']:
+            self.requests['count'] += 1
+            return self.requests['count'] % self.throttle_every == 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+
+        if self.throttled():
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if '/face/' in self.path:
+            # Every other image has a face
+            answer = []
+            if len(body) % 2 == 0:
+                answer = [{'faceAttributes': {
+                    'smile': 0.8, 'gender': 'female', 'age': 27.0,
+                    'emotion': {'happiness': 0.9, 'neutral': 0.1}}}]
+        elif '/vision/' in self.path:
+            answer = {'color': {'dominantColorForeground': 'White',
+                                'dominantColorBackground': 'Blue'}}
+        else:
+            # Google label detection, one response per image in the batch
+            count = int(self.headers.get('X-Image-Count', 1))
+            answer = {'responses': [
+                {'labelAnnotations': [{'description': 'product',
+                                       'score': 0.9}]}] * count}
+
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+# Local HTTP server standing in for the Google and Azure endpoints. Runs in
+# a background thread; 'url' is the base URL to give main.py's '--azure_url'.
+class StubServer:
+    def __init__(self, latency=0.0, port=0, throttle_every=0, retry_after=1):
+        handler = type('Handler', (StubHandler,), {
+            'latency': latency, 'throttle_every': throttle_every,
+            'retry_after': retry_after,
+            'requests': {'count': 0, 'lock': threading.Lock()}})
+        self.server = ThreadingServer(('127.0.0.1', port), handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Stands in for google.cloud.vision's ImageAnnotatorClient: sends the images
+# of a batch to the stub server over HTTP and turns its answer into real
+# AnnotateImageResponse objects.
+class StubVisionClient:
+    def __init__(self, url, session=None):
+        import requests
+
+        self.url = url + "v1/images:annotate"
+        self.session = session or requests.Session()
+
+    def batch_annotate_images(self, requests):
+        from google.cloud.vision import types
+
+        response = self.session.post(
+            self.url, data=b"".join(request.image.content
+                                    for request in requests),
+            headers={'X-Image-Count': str(len(requests))})
+        response.raise_for_status()
+
+        batch = types.BatchAnnotateImagesResponse()
+        for answer in response.json()['responses']:
+            image_response = batch.responses.add()
+            for label in answer['labelAnnotations']:
+                image_response.label_annotations.add(
+                    description=label['description'], score=label['score'])
+
+        return batch
+
+
+# Information stored with every set of results so runs can be compared
+def run_info():
+    revision = None
+    head = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), ".git", "HEAD")
+    try:
+        with open(head) as head_file:
+            revision = head_file.read().strip()
+        if revision.startswith("ref: "):
+            ref = os.path.join(os.path.dirname(head), revision[5:])
+            with open(ref) as ref_file:
+                revision = ref_file.read().strip()
+    except OSError:
+        pass
+
+    return {'time': datetime.datetime.now().isoformat(),
+            'revision': revision,
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+# Store benchmark results as JSON: run information plus a list of results,
+# each a dict with a unique 'key' and the measured values.
+def save_results(path, benchmark, results):
+    with open(path, 'w') as results_file:
+        json.dump({'benchmark': benchmark, 'info': run_info(),
+                   'results': results}, results_file, indent=2)
+
+
+# Compare 'results' with those stored in 'path' by an earlier run. For every
+# result with the same key, 'field' is compared; a change in the wrong
+# direction of more than 'threshold' (e.g. 0.1 for 10%) is a regression.
+# 'higher_is_better' is True for throughputs and False for times. Prints a
+# table and returns the number of regressions.
+def compare_results(path, results, field, higher_is_better=False,
+                    threshold=0.1):
+    with open(path) as results_file:
+        baseline = {result['key']: result
+                    for result in json.load(results_file)['results']}
+
+    regressions = 0
+    print("{:<45} {:>12} {:>12} {:>8}".format("benchmark", "baseline", "now",
+                                              "change"))
+    for result in results:
+        old = baseline.get(result['key'])
+        if old is None or not old[field]:
+            continue
+
+        change = result[field] / old[field] - 1
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{:<45} {:>12.4g} {:>12.4g} {:>+7.1%}{}".format(
+            result['key'], old[field], result[field], change, flag))
+
+    return regressions
@@ -0,0 +1,19 @@
+import runpy
+import sys
+import os
+
+import src.ImageProcessor
+from benchmarks.common import StubVisionClient
+
+
+# Runs main.py with the Google Vision client replaced by a StubVisionClient
+# talking to the stub server at $BENCH_STUB_URL (the Azure requests are sent
+# there with main.py's own '--azure_url'). Arguments are passed to main.py.
+# Used by bench_pipeline, so no Google credentials are needed.
+if __name__ == '__main__':
+    src.ImageProcessor._client = StubVisionClient(os.environ['BENCH_STUB_URL'])
+
+    main = os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), "main.py")
+    sys.argv = [main] + sys.argv[1:]
+    runpy.run_path(main, run_name='__main__')
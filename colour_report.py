@@ -0,0 +1,100 @@
+import optparse
+import random
+import time
+import os
+
+import pandas as pd
+
+from src.ImageProcessor import ImageProcessor, AZURE_URL, read_image
+from src.ResponseCache import ResponseCache
+
+
+# This script checks how often the dominant colours computed locally (see
+# DominantColour), which main.py writes unless '--azure_colours' is given,
+# agree with the ones the Microsoft Computer Vision API gives. On a random
+# sample of images it reports the share of images whose foreground colour,
+# background colour and both colours are the same, and the colour pairs
+# that disagree most often.
+#
+# With '--cache' the API answers are kept (the same cache as main.py's
+# '--cache'), so images main.py already sent to the API with
+# '--azure_colours' are compared without calling it again.
+def setup_parser():
+    tmp_parser = optparse.OptionParser()
+    tmp_parser.add_option("-i", "--image_dir", dest="image_dir", type="string",
+                          help="name of directory holding images")
+    tmp_parser.add_option("-n", "--sample", dest="sample", type="int",
+                          help="number of images to check")
+    tmp_parser.add_option("-u", "--azure_url", dest="azure_url",
+                          type="string", help="base URL of the Microsoft "
+                                              "Azure APIs")
+    tmp_parser.add_option("-c", "--cache", dest="cache", type="string",
+                          help="SQLite file caching API responses")
+    tmp_parser.add_option("-o", "--output", dest="output", type="string",
+                          help="CSV file to store the per-image values in")
+    tmp_parser.add_option("--seed", dest="seed", type="int",
+                          help="seed used to pick the sample")
+    tmp_parser.set_defaults(image_dir="2526_images/", sample=200,
+                            azure_url=AZURE_URL, cache=None, output=None,
+                            seed=0)
+
+    return tmp_parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+
+    names = sorted(name for name in os.listdir(opts.image_dir)
+                   if name.lower().endswith(".jpg"))
+    random.Random(opts.seed).shuffle(names)
+    names = names[:opts.sample]
+
+    cache = ResponseCache(opts.cache) if opts.cache else None
+
+    rows = []
+    local_time = 0
+    api_time = 0
+    for name in names:
+        path = os.path.join(opts.image_dir, name)
+        image_processor = ImageProcessor(path, azure_url=opts.azure_url,
+                                         cache=cache, data=read_image(path))
+
+        start = time.time()
+        foreground, background = image_processor.dominant_colours()
+        local_time += time.time() - start
+
+        start = time.time()
+        colours = image_processor.microsoft_cv_request()['color']
+        api_time += time.time() - start
+
+        rows.append((name, colours['dominantColorForeground'], foreground,
+                     colours['dominantColorBackground'], background))
+
+    frame = pd.DataFrame(rows, columns=['image', 'azure_foreground',
+                                        'local_foreground',
+                                        'azure_background',
+                                        'local_background'])
+    frame['foreground'] = frame['azure_foreground'] == \
+        frame['local_foreground']
+    frame['background'] = frame['azure_background'] == \
+        frame['local_background']
+    frame['both'] = frame['foreground'] & frame['background']
+    if opts.output:
+        frame.to_csv(opts.output, index=None)
+
+    print("Local dominant colours on {} images, agreement with the CV API"
+          .format(len(frame)))
+    print(frame[['foreground', 'background', 'both']].mean().to_string(
+        float_format=lambda value: "{:.4f}".format(value)))
+    for side in ('foreground', 'background'):
+        wrong = frame[~frame[side]]
+        if len(wrong):
+            pairs = wrong.groupby(['azure_' + side, 'local_' + side]).size()
+            print("Most frequent {} disagreements (Azure, local):"
+                  .format(side))
+            print(pairs.sort_values(ascending=False).head(10).to_string())
+    if names:
+        print("Seconds per image: local {:.4f}, CV API {:.4f}".format(
+            local_time / len(names), api_time / len(names)))
+    if cache is not None:
+        cache.close()
@@ -0,0 +1,114 @@
+import optparse
+import random
+import time
+import os
+
+import pandas as pd
+
+from src.FacePrefilter import FacePrefilter
+from src.ImageProcessor import ImageProcessor, AZURE_URL, read_image
+from src.ResponseCache import ResponseCache
+
+
+# This script checks what the local face pre-filter ('--face_prefilter' in
+# main.py) costs in accuracy. On a random sample of images it compares the
+# Face API's answer with the pre-filter's best detection score and reports,
+# for each threshold:
+#
+#   skipped       share of images that would not be sent to the Face API
+#   missed        images with a face (according to the API) that would be
+#                 skipped; their face columns get the no-face defaults
+#   recall        share of the images with a face that are still sent
+#   agreement     share of images whose output is unchanged
+#
+# With '--cache' the Face API answers are kept, so the sample can be checked
+# again (e.g. with another model) without calling the API.
+def setup_parser():
+    tmp_parser = optparse.OptionParser()
+    tmp_parser.add_option("-i", "--image_dir", dest="image_dir", type="string",
+                          help="name of directory holding images")
+    tmp_parser.add_option("-n", "--sample", dest="sample", type="int",
+                          help="number of images to check")
+    tmp_parser.add_option("-t", "--thresholds", dest="thresholds",
+                          type="string", help="comma separated thresholds "
+                                              "to report")
+    tmp_parser.add_option("--face_model", dest="face_model", type="string",
+                          help="YuNet ONNX model for the local face "
+                               "detector (Haar cascade otherwise)")
+    tmp_parser.add_option("-u", "--azure_url", dest="azure_url",
+                          type="string", help="base URL of the Microsoft "
+                                              "Azure APIs")
+    tmp_parser.add_option("-c", "--cache", dest="cache", type="string",
+                          help="SQLite file caching API responses")
+    tmp_parser.add_option("-o", "--output", dest="output", type="string",
+                          help="CSV file to store the per-image values in")
+    tmp_parser.add_option("--seed", dest="seed", type="int",
+                          help="seed used to pick the sample")
+    tmp_parser.set_defaults(image_dir="2526_images/", sample=200,
+                            thresholds=None, face_model=None,
+                            azure_url=AZURE_URL, cache=None, output=None,
+                            seed=0)
+
+    return tmp_parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+
+    if opts.thresholds:
+        thresholds = [float(value) for value in opts.thresholds.split(",")]
+    elif opts.face_model:
+        thresholds = [0.3, 0.5, 0.7, 0.9]
+    else:
+        thresholds = [-1.0, 0.0, 1.0, 2.0, 4.0]
+
+    names = sorted(name for name in os.listdir(opts.image_dir)
+                   if name.lower().endswith(".jpg"))
+    random.Random(opts.seed).shuffle(names)
+    names = names[:opts.sample]
+
+    cache = ResponseCache(opts.cache) if opts.cache else None
+    prefilter = FacePrefilter(model=opts.face_model)
+
+    rows = []
+    prefilter_time = 0
+    api_time = 0
+    for name in names:
+        path = os.path.join(opts.image_dir, name)
+        data = read_image(path)
+
+        start = time.time()
+        score = prefilter.score(data)
+        prefilter_time += time.time() - start
+
+        start = time.time()
+        faces = ImageProcessor(path, azure_url=opts.azure_url, cache=cache,
+                               data=data).microsoft_face_request()
+        api_time += time.time() - start
+
+        rows.append((name, len(faces), score))
+
+    frame = pd.DataFrame(rows, columns=['image', 'faces', 'score'])
+    if opts.output:
+        frame.to_csv(opts.output, index=None)
+
+    has_face = frame['faces'] > 0
+    report = []
+    for threshold in thresholds:
+        sent = frame['score'].notna() & (frame['score'] >= threshold)
+        missed = (has_face & ~sent).sum()
+        report.append((threshold, (~sent).mean(), missed,
+                       (has_face & sent).sum() / max(has_face.sum(), 1),
+                       1 - missed / max(len(frame), 1)))
+    report = pd.DataFrame(report, columns=['threshold', 'skipped', 'missed',
+                                           'recall', 'agreement'])
+
+    print("Face pre-filter ({}) on {} images, {} with a face".format(
+        "DNN" if opts.face_model else "Haar", len(frame), has_face.sum()))
+    print(report.to_string(index=False,
+                           float_format=lambda value: "{:.4f}".format(value)))
+    if names:
+        print("Seconds per image: pre-filter {:.4f}, Face API {:.4f}".format(
+            prefilter_time / len(names), api_time / len(names)))
+    if cache is not None:
+        cache.close()
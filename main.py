@@ -1,23 +1,218 @@
-import pandas as pd
-import shutil
+import concurrent.futures
+import cProfile
+import pstats
 import os
 
-from src.ImageProcessor import ImageProcessor
+from src.DuplicateIndex import DuplicateIndex
+from src.FacePrefilter import FacePrefilter
+from src.ImageProcessor import STAGES, init_worker, local_features
+from src.Pipeline import Pipeline
+from src.InputPlanner import InputPlanner
+from src.Journal import Journal
+from src.LabelIndex import LabelIndex
+from src.Materialiser import Materialiser
+from src.OutputWriter import OutputWriter
+from src.ResponseCache import ResponseCache
+from src.ShardMerger import MISSING_FILE, write_shard_info
+from src.Telemetry import Telemetry
+from src.VisionBatcher import GOOGLE_BATCH_LIMIT
 from src.Utilities import Utilities
 
 
-# This function renames files so that they are in the form 'INTEGER.jpg'
-# i.e. 0.jpg, 1.jpg, where the INTEGER corresponds with the relevant row number
-# in the output CSV file.
-def process_image(image_path, name):
-    # Rename file and place in output directory
-    dest = "output/images/" + name
-    shutil.copyfile(image_path, dest)
+# Names of the columns in the output CSV file, in the order 'build_row()'
+# returns them.
+COLUMN_NAMES = ['file_name', 'short_code', 'likes', 'followers', 'posts',
+                'following', 'faces', 'model_strategy', 'product_strategy',
+                'model_product_strategy', 'smile', 'gender', 'age', 'emotion',
+                'dom_fore_colour', 'dom_back_colour', 'labels',
+                'colourfulness', 'lines', 'smooth', 'saturation',
+                'brightness', 'contrast', 'clarity', 'hue', 'balance',
+                'canonical']
 
-    # Initialize ImageProcessor
-    image_processor = ImageProcessor(image_path)
+# Output columns that only depend on the image, shared by its duplicates
+# (see 'image_features()')
+FEATURE_COLUMNS = ['faces', 'model_strategy', 'product_strategy', 'smile',
+                   'gender', 'age', 'emotion', 'dom_fore_colour',
+                   'dom_back_colour', 'labels', 'colourfulness', 'lines',
+                   'smooth', 'saturation', 'brightness', 'contrast',
+                   'clarity', 'hue', 'balance']
 
-    return image_processor.detect_all()
+# Types of output columns that can't be guessed from a few rows. 'age' is -1
+# when no face is found and a float from the Face API otherwise.
+COLUMN_TYPES = {'age': 'float64'}
+
+# Unless '--in_flight' is given, this many images per worker process may be
+# in flight at any time, and at least a full Google batch (see VisionBatcher)
+# so the label requests are sent in batches. Bounding it keeps memory flat
+# while still giving every worker something to do.
+IN_FLIGHT_PER_WORKER = 2
+
+# Name of the work journal in the output details path (see Journal)
+JOURNAL_FILE = 'journal.jsonl'
+
+# Name of the list of output images and their sources (see Materialiser)
+MANIFEST_FILE = 'images.csv'
+
+# Name of the index of the labels CSV in the output details path, unless
+# '--label_index' is given (see LabelIndex)
+LABEL_INDEX_FILE = 'labels.index.npy'
+
+# Number of functions printed from the profile of each image ('--profile')
+PROFILE_LINES = 15
+
+
+# This function goes through each row of the work 'plan' (see InputPlanner),
+# i.e. the lines of the CSV file provided by the company whose image exists.
+# Each row corresponds to an Instagram image and contains information we need
+# including Instagram likes, followers, posts etc. It yields
+# ((index, row, file_name, short_code), image_path, file_name), the job format
+# used by Pipeline.run(). Rows the 'journal' already has finished are skipped.
+def find_jobs(plan, journal):
+    for index, row in zip(plan.index, plan.to_dict('records')):
+        short_code = row['short_code']
+        if journal.is_done(index, short_code):
+            continue
+
+        # Because the Instagram images have messy names like
+        # 'BcMylPTlU4N.jpg', this line re-names it to: 'ROW_NUMBER.jpg'
+        # i.e. if we are on row 5, the new name of the file will be '5.jpg'
+        # (the images are copied to the output directory under this name).
+        file_name = str(index) + ".jpg"
+
+        yield (index, row, file_name, short_code), row['image_path'], file_name
+
+
+# Reduce the responses of an image from 'process_image()' to its features,
+# the output columns that only depend on the image (see FEATURE_COLUMNS), as
+# a tuple. These are all the pipeline keeps of an image for its duplicates.
+# The columns of the stages left out of the run ('--stages') are None, i.e.
+# empty.
+def image_features(response_list):
+    # The following lines get the output of the Google API (object
+    # detection) and create a string containing names of all objects
+    # detected.
+    labels = None
+    if response_list[0] is not None:
+        labels = ""
+        space = False
+        for label in response_list[0].label_annotations:
+            if space:
+                labels += " "
+            space = True
+            labels += label.description
+
+    # The following lines use the output of the Microsoft Azure Face
+    # API
+    msft_face = response_list[1]
+    if msft_face is None:
+        faces = model_strategy = product_strategy = None
+        smile = gender = age = emotion = None
+    else:
+        faces = len(msft_face)
+        model_strategy = (faces > 0)
+        product_strategy = not model_strategy
+
+        # Default attributes to use if no faces are found.
+        smile = False
+        gender = "unknown"
+        age = -1
+        emotion = "unknown"
+
+    # TODO: Fix for multiple faces
+    # The following lines record characteristics of detected faces
+    # such as whether they are smiling/what emotion is being displayed
+    # etc.
+    if msft_face:
+        smile = msft_face[0]['faceAttributes']['smile'] >= 0.5
+        gender = msft_face[0]['faceAttributes']['gender']
+        age = msft_face[0]['faceAttributes']['age']
+        emotion = max(
+            msft_face[0]['faceAttributes']['emotion'].keys(),
+            key=(lambda key:
+                 msft_face[0]['faceAttributes']['emotion'][key]))
+
+    # Colour attributes from the Microsoft CV API with '--azure_colours',
+    # computed locally otherwise
+    msft_cv = response_list[2]
+    dom_fore_colour = dom_back_colour = None
+    if msft_cv is not None:
+        dom_fore_colour = msft_cv['color']['dominantColorForeground']
+        dom_back_colour = msft_cv['color']['dominantColorBackground']
+    elif response_list[12] is not None:
+        dom_fore_colour, dom_back_colour = response_list[12]
+
+    # Return OpenCV responses
+    colourfulness = response_list[3]
+    lines = response_list[4]
+    smooth = response_list[5]
+    saturation = response_list[6]
+    brightness = response_list[7]
+    contrast = response_list[8]
+    clarity = response_list[9]
+    hue = response_list[10]
+    balance = response_list[11]
+
+    # Put all the features we have detected into a tuple.
+    return (faces, model_strategy, product_strategy, smile, gender, age,
+            emotion, dom_fore_colour, dom_back_colour, labels,
+            colourfulness, lines, smooth, saturation, brightness, contrast,
+            clarity, hue, balance)
+
+
+# Features of an output row (e.g. one read back from the journal), as
+# 'image_features()' returns them
+def row_features(row):
+    return tuple(row[COLUMN_NAMES.index(column)]
+                 for column in FEATURE_COLUMNS)
+
+
+# Turn the CSV row and the features from 'image_features()' into the tuple
+# stored in the output CSV file (see COLUMN_NAMES). 'canonical' is the file
+# name of the image the features are from: 'file_name' itself, or an
+# earlier image this one is a duplicate of (see '--dedup').
+def build_row(row, file_name, short_code, features, label_index, canonical):
+    original_file_name = short_code + ".jpg"
+    values = dict(zip(FEATURE_COLUMNS, features))
+
+    # The following lines store the information found in the CSV.
+    values['file_name'] = file_name
+    values['short_code'] = short_code
+    values['likes'] = row['edge_liked_by_count']
+    values['followers'] = row['user_followers']
+    values['posts'] = row['user_posts']
+    values['following'] = row['user_following']
+    values['canonical'] = canonical
+
+    # Set threshold for model + product strategy here. It depends on the
+    # labels of this image's own file, so it is not shared by duplicates.
+    model_and_product = None
+    if values['faces'] is not None:
+        model_and_product = False
+        if values['faces'] > 0:
+            model_and_product = \
+                label_index.maximum(original_file_name) > 0.05
+    values['model_product_strategy'] = model_and_product
+
+    return tuple(values[column] for column in COLUMN_NAMES)
+
+
+# Analyse the OpenCV side of each of the 'slowest' images (see
+# Telemetry.slowest()) again, under cProfile. The API requests are not
+# repeated: their time is network wait, which the stage timings already show.
+# Each profile is written to 'directory' as 'profile_NAME.prof' (for pstats
+# or snakeviz) and the functions with the most cumulative time are printed.
+def profile_slowest(slowest, settings, directory):
+    for local_seconds, name, path in slowest:
+        profiler = cProfile.Profile()
+        profiler.runcall(local_features, path, **settings)
+        profile_path = os.path.join(
+            directory, "profile_" + os.path.splitext(name)[0] + ".prof")
+        profiler.dump_stats(profile_path)
+
+        print("Profile of {} ({}, {:.3f}s of OpenCV work), saved to {}"
+              .format(name, path, local_seconds, profile_path))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(
+            PROFILE_LINES)
 
 
 # Start program
@@ -29,148 +224,189 @@ if __name__ == '__main__':
     # Read user input
     opts, args = util.setup_parser()
 
+    # Stages of the analysis to run (see STAGES in ImageProcessor). The
+    # columns of the others are left empty.
+    stages = util.parse_stages(opts.stages, STAGES)
+    if opts.azure_colours and 'cv' not in stages:
+        stages.append('cv')
+    if opts.local_only:
+        stages = ['local']
+
+    # With '--face_prefilter' images a local face detector finds no face in
+    # are not sent to the Face API and get the no-face defaults. The detector
+    # is built here, so a missing model fails before any output is written.
+    face_prefilter = None
+    if opts.face_prefilter and 'face' in stages:
+        face_prefilter = FacePrefilter(threshold=opts.face_threshold,
+                                       model=opts.face_model)
+
     # Create output directories
     util.create_directories(opts.new_details, opts.new_image_dir)
 
-    # Read CSV files provided by company (DHC)
-    original_csv = pd.read_csv(opts.details)
-    label_csv = pd.read_csv(opts.labels)
+    # Read CSV files provided by company (DHC) and find the rows whose image
+    # is in the image directory. With '--shard K/N' only the rows of shard K
+    # are analysed; merge.py combines the outputs of all N shards.
+    shard, shards = util.parse_shard(opts.shard)
+    planner = InputPlanner(opts.details, opts.image_dir, shard=shard,
+                           shards=shards)
+    plan, missing = planner.plan()
+    missing.to_csv(os.path.join(opts.new_details, MISSING_FILE),
+                   index_label='index')
+    write_shard_info(opts.new_details, shard, shards, planner.rows,
+                     opts.output_file)
+    print("{} images to analyse, {} not found (see {})".format(
+        len(plan), len(missing), MISSING_FILE))
 
-    # Initialize empty list which will be used to store relevant details
-    # for each image i.e. details extracted from DHC original_csv and other
-    # detected features during analysis.
-    new_csv = []
+    # Only the largest label value of each image is used, so the labels CSV
+    # is reduced to an index of column maxima the first time it is seen (see
+    # LabelIndex) and later runs open that instead. It is only read for
+    # images with a face. The index is kept with the output, as the input
+    # directory may be read-only.
+    label_index = None
+    if 'face' in stages:
+        index_path = opts.label_index or os.path.join(opts.new_details,
+                                                      LABEL_INDEX_FILE)
+        label_index = LabelIndex(opts.labels, index_path=index_path)
 
-    # Count variable is used to keep track of (and print on screen) how many
-    # lines we have processed so far.
-    count = 1
+    # Every finished image is recorded in the journal. With '--resume' the
+    # images a previous (crashed) run finished are not analysed again.
+    journal = Journal(os.path.join(opts.new_details, JOURNAL_FILE),
+                      resume=opts.resume)
+    if opts.resume:
+        print("Resuming: {} images already done".format(len(journal.done)))
 
-    # Timer is used to stop the for-loop when it reaches a certain number
-    # timer = 0
+    # The relevant details for each image i.e. details extracted from DHC
+    # original_csv and other detected features during analysis are streamed
+    # to this file (by default 'output/details.csv'), which can be used for
+    # the statistical analysis. Rows are appended in chunks rather than
+    # rewriting the whole file for every image. A resumed run writes the
+    # file from the journal once all images are done instead.
+    output_path = os.path.join(opts.new_details, opts.output_file)
+    writer = None
+    if not opts.resume:
+        writer = OutputWriter(output_path, COLUMN_NAMES, dtypes=COLUMN_TYPES,
+                              chunk_rows=opts.chunk_rows)
 
-    # The following for-loop goes through each line of the 'original_csv' file
-    # provided by the company. Each row corresponds to an Instagram image and
-    # contains information we need including Instagram likes, followers, posts
-    # etc.
-    for index, row in original_csv.iterrows():
-        # The following lines store the information found in the CSV and
-        # updates each time we go to a new line.
-        likes = row['edge_liked_by_count']
-        followers = row['user_followers']
-        posts = row['user_posts']
-        following = row['user_following']
-        short_code = row['shortcode']
-        if short_code[-1] == "'":
-            short_code = short_code[:-1]
-        original_file_name = short_code + ".jpg"
-
-        # We create a computer system PATH (like a location) to the Instagram
-        # image that the current row is associated with.
-        tmp_path = os.path.join(opts.image_dir, original_file_name)
-
-        # Check if the PATH we created actually leads to a file (our PATH may
-        # not lead to a file if we made a mistake or the file is missing)
-        if os.path.isfile(tmp_path):
-            # Print number of lines processed so far
-            print("Count: {}".format(count))
-
-            # Because the Instagram images have messy names like
-            # 'BcMylPTlU4N.jpg', this line re-names it to: 'ROW_NUMBER.jpg'
-            # i.e. if we are on row 5, the new name of the file will be '5.jpg'
-            file_name = str(row.name) + ".jpg"
-
-            # Call the process_image function (see above around line 13 of this
-            # code) and five the function the file path we created.
-            # goog_cv, msft_face, msft_cv, saturation, lines, smooth =\
-            #     process_image(tmp_path, file_name)
-
-            response_list = process_image(tmp_path, file_name)
-
-            # The following lines get the output of the Google API (object
-            # detection) and create a string containing names of all objects
-            # detected.
-            labels = ""
-            space = False
-            # for label in goog_cv.responses[0].label_annotations:
-            for label in response_list[0].responses[0].label_annotations:
-                if space:
-                    labels += " "
-                space = True
-                labels += label.description
-
-            # The following lines use the output of the Microsoft Azure Face
-            # API
-            msft_face = response_list[1]
-            faces = len(msft_face)
-            model_strategy = (faces > 0)
-            product_strategy = not model_strategy
-
-            # Default attributes to use if no faces are found.
-            smile = False
-            gender = "unknown"
-            age = -1
-            emotion = "unknown"
-            model_and_product = False
-
-            # TODO: Fix for multiple faces
-            # The following lines record characteristics of detected faces
-            # such as whether they are smiling/what emotion is being displayed
-            # etc.
-            if msft_face:
-                smile = msft_face[0]['faceAttributes']['smile'] >= 0.5
-                gender = msft_face[0]['faceAttributes']['gender']
-                age = msft_face[0]['faceAttributes']['age']
-                emotion = max(
-                    msft_face[0]['faceAttributes']['emotion'].keys(),
-                    key=(lambda key:
-                         msft_face[0]['faceAttributes']['emotion'][key]))
-
-                # Set threshold for model + product strategy here
-                file_column = label_csv[original_file_name]
-                model_and_product = max(file_column) > 0.05
-
-            # Colour attributes from Microsoft CV API
-            msft_cv = response_list[2]
-            dom_fore_colour = msft_cv['color']['dominantColorForeground']
-            dom_back_colour = msft_cv['color']['dominantColorBackground']
-
-            # Return OpenCV responses
-            colourfulness = response_list[3]
-            lines = response_list[4]
-            # smooth = response_list[5]
-            saturation = response_list[5]
-            brightness = response_list[6]
-            contrast = response_list[7]
-            clarity = response_list[8]
-            hue = response_list[9]
-            balance = response_list[10]
-
-            # Put all the features we have detected into a Python list.
-            new_csv.append((file_name, short_code, likes, followers, posts,
-                            following, faces, model_strategy,
-                            product_strategy, model_and_product, smile, gender,
-                            age, emotion, dom_fore_colour, dom_back_colour,
-                            labels, colourfulness, lines, saturation,
-                            brightness, contrast, clarity, hue, balance))
-        else:
-            print("Image short-code: {} not found".format(short_code))
-
-        # Convert the list with all detected features into a Pandas DataFrame.
-        column_names = ['file_name', 'short_code', 'likes', 'followers',
-                        'posts', 'following', 'faces', 'model_strategy',
-                        'product_strategy', 'model_product_strategy', 'smile',
-                        'gender', 'age', 'emotion', 'dom_fore_colour',
-                        'dom_back_colour', 'labels', 'colourfulness', 'lines',
-                        'saturation', 'brightness', 'contrast',
-                        'clarity', 'hue', 'balance']
-        frame = pd.DataFrame(new_csv, columns=column_names)
-
-        # Convert Pandas DataFrame to CSV file and store on disk. This file can
-        # be used for the statistical analysis.
-        frame.to_csv('output/details.csv', index=None)
-
-        # Set timer value to stop program at here
-        # if timer >= 8:
-        #     break
-        count += 1
-        # timer += 1
+    # With '--workers N' the OpenCV metrics run in N worker processes,
+    # otherwise they run in the pipeline's thread pool.
+    pool = None
+    if opts.workers > 0:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=opts.workers, initializer=init_worker)
+
+    # Number of images analysed at the same time. API requests for these
+    # images overlap with each other and with the OpenCV metrics.
+    in_flight = opts.in_flight
+    if in_flight is None:
+        in_flight = max(GOOGLE_BATCH_LIMIT,
+                        opts.workers * IN_FLIGHT_PER_WORKER)
+
+    # API responses are looked up in (and added to) an on-disk cache when
+    # '--cache' is given, so unchanged images are not sent again.
+    cache = None
+    if opts.cache:
+        max_bytes = None
+        if opts.cache_max_mb is not None:
+            max_bytes = int(opts.cache_max_mb * 1024 * 1024)
+        max_age = None
+        if opts.cache_max_days is not None:
+            max_age = opts.cache_max_days * 24 * 60 * 60
+        cache = ResponseCache(opts.cache, max_bytes=max_bytes,
+                              max_age=max_age)
+
+    # The renamed images are placed in the output image directory by a
+    # background thread, with the strategy chosen by '--materialise'.
+    materialiser = Materialiser(
+        opts.new_image_dir, os.path.join(opts.new_details, MANIFEST_FILE),
+        strategy=opts.materialise, append=opts.resume)
+
+    # Time spent in each stage of every image, cache hits and API errors are
+    # collected here. Progress is printed every '--stats_interval' seconds,
+    # when the summary in '--stats_file' is rewritten as well.
+    telemetry = Telemetry(log_path=opts.log_file,
+                          summary_path=opts.stats_file,
+                          interval=opts.stats_interval,
+                          keep_slowest=opts.profile)
+
+    # With '--dedup' images that look like an earlier image (reposts,
+    # re-encoded or resized copies) reuse its analysis
+    duplicates = None
+    if opts.dedup:
+        duplicates = DuplicateIndex(max_distance=opts.dedup_distance)
+
+    local_settings = {'smooth_window': opts.smooth_window,
+                      'proxy_scale': opts.proxy_scale}
+    pipeline = Pipeline(materialiser, in_flight=in_flight,
+                        local_executor=pool, azure_url=opts.azure_url,
+                        cache=cache, local_settings=local_settings,
+                        telemetry=telemetry, face_prefilter=face_prefilter,
+                        duplicates=duplicates,
+                        rates={'google': opts.google_rate,
+                               'face': opts.face_rate, 'cv': opts.cv_rate},
+                        max_retries=opts.max_retries,
+                        stages=stages, summarise=image_features)
+
+    # A resumed run first adds the canonical images of the earlier runs to
+    # the duplicate index, in row order as they were added then, so their
+    # later duplicates get the same canonical image as in an uninterrupted
+    # run and are not analysed again.
+    if duplicates is not None:
+        for index in sorted(journal.hashes):
+            short_code, done_row = journal.done[index]
+            file_name = done_row[COLUMN_NAMES.index('file_name')]
+            if done_row[COLUMN_NAMES.index('canonical')] == file_name:
+                pipeline.add_canonical(file_name, journal.hashes[index],
+                                       row_features(done_row))
+
+    # Called with the features of each image, in the order of the plan
+    def on_result(item, features, canonical, image_hash):
+        index, row, file_name, short_code = item
+        new_row = build_row(row, file_name, short_code, features,
+                            label_index, canonical)
+        journal.record(index, short_code, new_row, image_hash=image_hash)
+        if writer is not None:
+            writer.write(new_row)
+
+    try:
+        pipeline.run(find_jobs(plan, journal), on_result)
+    finally:
+        # The summary, the output copies and the finished rows still held
+        # by the writer are written even if the run fails, e.g. on an API
+        # error
+        telemetry.close()
+        pipeline.close()
+        materialiser.close()
+        if pool is not None:
+            pool.shutdown()
+        if writer is not None:
+            writer.close()
+        journal.close()
+    if opts.profile > 0:
+        profile_slowest(telemetry.slowest(), local_settings, opts.new_details)
+    if opts.verify != 'none':
+        problems = materialiser.verify(check_hash=(opts.verify == 'hash'))
+        for problem in problems:
+            print("Output image check failed: {}".format(problem))
+        print("Output images checked: {} problems".format(len(problems)))
+
+    # Every worker holds one image (its bytes, decoded pixels and the
+    # intermediates of its metrics) at a time, and the main process at most
+    # 'in_flight' images, so these stay flat however many images there are.
+    own_memory, worker_memory = util.peak_memory()
+    if own_memory is None:
+        print("Peak memory: not reported on this platform")
+    else:
+        print("Peak memory: {:.0f} MB main process".format(own_memory))
+        if pool is not None:
+            print("Peak memory: {:.0f} MB per worker".format(worker_memory))
+    if cache is not None:
+        print("Response cache: {}".format(cache.summary()))
+        cache.close()
+
+    # Compaction: a resumed run rewrites the output file from the journal,
+    # in row order, so it matches the output of an uninterrupted run.
+    if writer is None:
+        writer = OutputWriter(output_path, COLUMN_NAMES, dtypes=COLUMN_TYPES,
+                              chunk_rows=opts.chunk_rows)
+        journal.compact(writer)
+        writer.close()
@@ -0,0 +1,53 @@
+import optparse
+import sys
+import os
+
+from src.ShardMerger import ShardMerger
+
+
+# This script combines the outputs of runs of main.py with '--shard K/N'
+# into the output of a single run. Give it the output details path of every
+# shard:
+#
+#   python merge.py -a output/ shard0/ shard1/ shard2/ shard3/
+#
+# The shards are checked first (every shard present once, no row twice, no
+# row missing); nothing is written if a check fails, unless '--force' is
+# given.
+def setup_parser():
+    tmp_parser = optparse.OptionParser(
+        usage="%prog [options] SHARD_DETAILS_PATH...")
+    tmp_parser.add_option("-a", "--new_details", dest="new_details",
+                          type="string", help="output details path of the "
+                                              "merged output")
+    tmp_parser.add_option("-o", "--output_file", dest="output_file",
+                          type="string", help="name of the merged output "
+                                              "file (by default the name "
+                                              "the shards used)")
+    tmp_parser.add_option("-f", "--force", dest="force", action="store_true",
+                          help="write the merged output even if the checks "
+                               "fail")
+    tmp_parser.set_defaults(new_details="output/", output_file=None,
+                            force=False)
+
+    return tmp_parser.parse_args()
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+    if not args:
+        sys.exit("No shard output directories given")
+
+    merger = ShardMerger(args, output_file=opts.output_file)
+    merger.load()
+    problems = merger.check()
+    for problem in problems:
+        print("Check failed: {}".format(problem))
+    if problems and not opts.force:
+        sys.exit("{} problems, nothing written".format(len(problems)))
+
+    if not os.path.exists(opts.new_details):
+        os.makedirs(opts.new_details)
+    path = merger.write(opts.new_details)
+    print("Merged {} shards, {} rows, into {}".format(
+        len(args), len(merger.details), path))
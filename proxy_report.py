@@ -0,0 +1,109 @@
+import optparse
+import numbers
+import random
+import time
+import os
+
+import pandas as pd
+
+from src.ImageProcessor import ImageProcessor, LOCAL_METRICS
+
+
+# This script checks how far the OpenCV metrics computed on a reduced
+# resolution proxy of each image ('--proxy_scale' in main.py) are from the
+# values computed on the full resolution image. It runs both on a random
+# sample of images and reports, for every metric that uses the proxy, the
+# mean and largest absolute error, the mean relative error and the share of
+# images within the given relative tolerance. Metrics whose values are not
+# numbers (the dominant colours) are reported as the share of images whose
+# proxy value is the same as the full resolution one. The time per image of
+# both modes is reported as well.
+def setup_parser():
+    tmp_parser = optparse.OptionParser()
+    tmp_parser.add_option("-i", "--image_dir", dest="image_dir", type="string",
+                          help="name of directory holding images")
+    tmp_parser.add_option("-s", "--proxy_scale", dest="proxy_scale",
+                          type="int", help="proxy scale to check (2, 4 or 8)")
+    tmp_parser.add_option("-n", "--sample", dest="sample", type="int",
+                          help="number of images to check")
+    tmp_parser.add_option("-t", "--tolerance", dest="tolerance",
+                          type="float", help="relative error allowed per "
+                                             "metric")
+    tmp_parser.add_option("-o", "--output", dest="output", type="string",
+                          help="CSV file to store the per-image values in")
+    tmp_parser.add_option("--seed", dest="seed", type="int",
+                          help="seed used to pick the sample")
+    tmp_parser.set_defaults(image_dir="2526_images/", proxy_scale=4,
+                            sample=200, tolerance=0.02, output=None, seed=0)
+
+    return tmp_parser.parse_args()
+
+
+def local_metrics(path, proxy_scale):
+    start = time.time()
+    values = ImageProcessor(path, proxy_scale=proxy_scale).local_metrics()
+
+    return values, time.time() - start
+
+
+if __name__ == '__main__':
+    opts, args = setup_parser()
+
+    names = sorted(name for name in os.listdir(opts.image_dir)
+                   if name.lower().endswith(".jpg"))
+    random.Random(opts.seed).shuffle(names)
+    names = names[:opts.sample]
+
+    # Metrics computed on the proxy, and their position in the response list
+    proxy_metrics = [(position, metric[0])
+                     for position, metric in enumerate(LOCAL_METRICS)
+                     if metric[3]]
+
+    rows = []
+    matches = []
+    full_time = 0
+    proxy_time = 0
+    for name in names:
+        path = os.path.join(opts.image_dir, name)
+        full, seconds = local_metrics(path, 1)
+        full_time += seconds
+        proxy, seconds = local_metrics(path, opts.proxy_scale)
+        proxy_time += seconds
+
+        for position, metric in proxy_metrics:
+            if isinstance(full[position], numbers.Number):
+                rows.append((name, metric, full[position], proxy[position]))
+            else:
+                matches.append((name, metric, full[position],
+                                proxy[position],
+                                full[position] == proxy[position]))
+
+    frame = pd.DataFrame(rows, columns=['image', 'metric', 'full', 'proxy'])
+    matches = pd.DataFrame(matches, columns=['image', 'metric', 'full',
+                                             'proxy', 'match'])
+    frame['error'] = (frame['proxy'] - frame['full']).abs()
+    frame['relative_error'] = frame['error'] / frame['full'].abs().clip(
+        lower=1e-9)
+    frame['within'] = frame['relative_error'] <= opts.tolerance
+    if opts.output:
+        pd.concat([frame, matches], sort=False).to_csv(opts.output,
+                                                       index=None)
+
+    grouped = frame.groupby('metric', sort=False)
+    report = pd.DataFrame({
+        'mean_error': grouped['error'].mean(),
+        'max_error': grouped['error'].max(),
+        'mean_relative_error': grouped['relative_error'].mean(),
+        'within_tolerance': grouped['within'].mean()})
+    print("Proxy scale 1/{} on {} images, tolerance {:.1%}".format(
+        opts.proxy_scale, len(names), opts.tolerance))
+    print(report.to_string(float_format=lambda value: "{:.4f}".format(value)))
+    if len(matches):
+        report = pd.DataFrame({
+            'same_value': matches.groupby('metric', sort=False)['match']
+            .mean()})
+        print(report.to_string(
+            float_format=lambda value: "{:.4f}".format(value)))
+    if names:
+        print("Seconds per image: full {:.4f}, proxy {:.4f}".format(
+            full_time / len(names), proxy_time / len(names)))
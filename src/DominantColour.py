@@ -0,0 +1,113 @@
+import cv2
+import numpy as np
+
+
+# Colour names the Microsoft Computer Vision API gives the dominant
+# foreground and background colours, with the RGB value each stands for
+AZURE_COLOURS = [("Black", 0, 0, 0), ("Blue", 0, 0, 255),
+                 ("Brown", 139, 69, 19), ("Grey", 128, 128, 128),
+                 ("Green", 0, 128, 0), ("Orange", 255, 165, 0),
+                 ("Pink", 255, 192, 203), ("Purple", 128, 0, 128),
+                 ("Red", 255, 0, 0), ("Teal", 0, 128, 128),
+                 ("White", 255, 255, 255), ("Yellow", 255, 255, 0)]
+
+# Basic colour RGB values:
+# https://www.rapidtables.com/web/color/RGB_Color.html
+BASIC_COLOURS = [("red", 255, 0, 0), ("lime", 0, 255, 0),
+                 ("blue", 0, 0, 255), ("yellow", 255, 255, 0),
+                 ("cyan", 0, 255, 255), ("magenta", 255, 0, 255),
+                 ("silver", 192, 192, 192), ("gray", 128, 128, 128),
+                 ("maroon", 128, 0, 0), ("olive", 128, 128, 0),
+                 ("green", 0, 128, 0), ("purple", 128, 0, 128),
+                 ("teal", 0, 128, 128), ("navy", 0, 0, 128)]
+
+# Side of the square sample the colours are taken from. Colour proportions
+# survive shrinking with INTER_AREA, so a few thousand pixels are enough.
+SAMPLE_SIZE = 64
+
+# Bits kept of each channel when the sample is quantized into a palette
+QUANT_BITS = 4
+
+# Width of the border, as a fraction of the side, whose colour is the
+# background; the foreground is the colour of the middle half of the image
+BORDER = 1 / 8
+
+
+# Convert an (N, 3) array of RGB values (0 to 255) to CIE Lab, in which
+# Euclidean distances are close to perceived colour differences
+def to_lab(rgb):
+    rgb = np.asarray(rgb, dtype=np.float32).reshape(-1, 1, 3) / 255
+
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2Lab).reshape(-1, 3)
+
+
+# This class names the colours of an image with the nearest of a fixed set of
+# 'colours', (name, red, green, blue) tuples. The image is shrunk to a
+# SAMPLE_SIZE square sample whose pixels are quantized to QUANT_BITS bits a
+# channel; the mean colour of each occupied bin makes up the palette, and all
+# palette entries are matched to their nearest named colour (in Lab) with a
+# single distance matrix. A name's weight is the number of pixels whose bin
+# it was given.
+class ColourNamer:
+    def __init__(self, colours):
+        self.names = [colour[0] for colour in colours]
+        self.references = to_lab([colour[1:] for colour in colours])
+
+    # Index of the nearest named colour of each row of 'rgb', an (N, 3) array
+    def nearest(self, rgb):
+        lab = to_lab(rgb)
+        distances = np.square(lab[:, np.newaxis, :] -
+                              self.references[np.newaxis, :, :]).sum(axis=2)
+
+        return distances.argmin(axis=1)
+
+    # Shrink the BGR image 'bgr' to the sample and return the named colour
+    # index of each of its pixels, as a SAMPLE_SIZE square array
+    def name_pixels(self, bgr):
+        sample = cv2.resize(bgr, (SAMPLE_SIZE, SAMPLE_SIZE),
+                            interpolation=cv2.INTER_AREA)
+        pixels = sample.reshape(-1, 3)[:, ::-1].astype(np.int64)
+
+        # Palette: mean colour of the pixels of each occupied bin
+        levels = 1 << QUANT_BITS
+        bins = pixels >> (8 - QUANT_BITS)
+        codes = (bins[:, 0] * levels + bins[:, 1]) * levels + bins[:, 2]
+        _, inverse, counts = np.unique(codes, return_inverse=True,
+                                       return_counts=True)
+        palette = np.stack([np.bincount(inverse.ravel(),
+                                        weights=pixels[:, channel])
+                            for channel in range(3)], axis=1)
+        palette /= counts[:, np.newaxis]
+
+        named = self.nearest(palette)[inverse.ravel()]
+
+        return named.reshape(SAMPLE_SIZE, SAMPLE_SIZE)
+
+    # Name of the colour covering most of 'named' (from 'name_pixels()')
+    def dominant(self, named):
+        weights = np.bincount(named.ravel(), minlength=len(self.names))
+
+        return self.names[int(weights.argmax())]
+
+    # Name of the dominant colour of the whole BGR image 'bgr'
+    def dominant_colour(self, bgr):
+        return self.dominant(self.name_pixels(bgr))
+
+    # (foreground, background) names of the BGR image 'bgr': the dominant
+    # colours of the middle half of the image and of its border
+    def foreground_background(self, bgr):
+        named = self.name_pixels(bgr)
+        border = max(1, int(SAMPLE_SIZE * BORDER))
+        quarter = SAMPLE_SIZE // 4
+
+        inside = np.zeros(named.shape, dtype=bool)
+        inside[border:-border, border:-border] = True
+        middle = named[quarter:SAMPLE_SIZE - quarter,
+                       quarter:SAMPLE_SIZE - quarter]
+
+        return self.dominant(middle), self.dominant(named[~inside])
+
+
+# Namers shared by every ImageProcessor in the process
+AZURE_NAMER = ColourNamer(AZURE_COLOURS)
+BASIC_NAMER = ColourNamer(BASIC_COLOURS)
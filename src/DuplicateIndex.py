@@ -0,0 +1,82 @@
+import cv2
+import numpy as np
+
+
+# Side of the gray thumbnail the difference hash is computed from; the hash
+# has HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+# Difference hash (dHash) of the image bytes 'data': the image is shrunk to
+# a (HASH_SIZE + 1) x HASH_SIZE gray thumbnail and every bit says whether a
+# pixel is brighter than its right neighbour. Re-encoded, resized or lightly
+# edited copies of an image get the same or nearly the same hash. Returns
+# an int, or None if the image can not be decoded.
+def dhash(data):
+    # Decoding at 1/8 of the size is plenty for a 9 x 8 thumbnail
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8),
+                        cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+
+    thumbnail = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE),
+                           interpolation=cv2.INTER_AREA)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+# Number of bits in which the hashes 'a' and 'b' differ
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# This class finds, among the hashes added so far, the ones within a given
+# Hamming distance of a hash. It is a BK-tree: every node keeps its children
+# by their distance to it, and the triangle inequality rules out every child
+# whose distance differs from the query's by more than the maximum, so only a
+# small part of the tree is visited.
+class DuplicateIndex:
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+
+        # Nodes are [hash, name, number added before it, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    # Add the image 'name' with hash 'image_hash'
+    def add(self, image_hash, name):
+        node = [image_hash, name, self.size, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+
+        parent = self.root
+        while True:
+            distance = hamming(image_hash, parent[0])
+            child = parent[3].get(distance)
+            if child is None:
+                parent[3][distance] = node
+                return
+            parent = child
+
+    # Return the name of the closest image within 'max_distance' of
+    # 'image_hash' (the one added first if several are as close), or None.
+    def find(self, image_hash):
+        best = None
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(image_hash, node[0])
+            if distance <= self.max_distance:
+                if best is None or (distance, node[2]) < best[:2]:
+                    best = (distance, node[2], node[1])
+            for child_distance, child in node[3].items():
+                if abs(child_distance - distance) <= self.max_distance:
+                    stack.append(child)
+
+        return None if best is None else best[2]
+
+    def __len__(self):
+        return self.size
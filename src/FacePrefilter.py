@@ -0,0 +1,112 @@
+import threading
+import os
+
+import cv2
+import numpy as np
+
+
+# Face cascade shipped with OpenCV, used unless a DNN model is given
+HAAR_CASCADE = 'haarcascade_frontalface_default.xml'
+
+# Default thresholds: the Haar cascade scores a detection with the weight of
+# its last stage (about -1 to 8), the DNN (YuNet) detector with a confidence
+# between 0 and 1
+HAAR_THRESHOLD = 0.0
+DNN_THRESHOLD = 0.5
+
+# Lowest confidence the DNN detector reports at all, so 'score()' can be
+# compared with thresholds below the one in use (see face_report.py)
+DNN_SCORE_FLOOR = 0.05
+
+# Smallest face looked for, in pixels of the half size image
+MIN_FACE = 24
+
+
+# This class decides locally, before the Face API is called, whether an image
+# may have a face in it. Product shots without people are the bulk of the
+# catalogue, and sending them to the Face API only ever gives back an empty
+# list, so ImageProcessor skips the call for images this class finds no face
+# in (see 'face_prefilter').
+#
+# The image is decoded at half size and searched with OpenCV's Haar face
+# cascade or, when 'model' is the path of a YuNet ONNX model, with OpenCV's
+# DNN face detector. The image may have a face when its best detection
+# scores at least 'threshold'. Lowering the threshold sends more images to
+# the Face API (fewer faces missed), raising it skips more. face_report.py
+# measures the trade-off on a sample.
+#
+# A detector is built when the pre-filter is created, so a missing model or
+# an OpenCV build without the detector raises a ValueError before any image
+# is analysed.
+class FacePrefilter:
+    def __init__(self, threshold=None, model=None):
+        self.model = model
+        if threshold is None:
+            threshold = HAAR_THRESHOLD if model is None else DNN_THRESHOLD
+        self.threshold = threshold
+
+        # Detectors keep state between calls, so every thread (one per image
+        # being analysed) gets its own
+        self.local = threading.local()
+        self.local.detector = self._create_detector()
+
+    def _create_detector(self):
+        if self.model is None:
+            if not hasattr(cv2, 'CascadeClassifier'):
+                raise ValueError("This OpenCV build has no Haar cascades, "
+                                 "a YuNet model must be given "
+                                 "('--face_model')")
+            detector = cv2.CascadeClassifier(cv2.data.haarcascades +
+                                             HAAR_CASCADE)
+            if detector.empty():
+                raise ValueError("Cannot load the face cascade {}"
+                                 .format(HAAR_CASCADE))
+            return detector
+
+        if not hasattr(cv2, 'FaceDetectorYN'):
+            raise ValueError("This OpenCV build has no DNN face detector")
+        if not os.path.isfile(self.model):
+            raise ValueError("Face model {} not found".format(self.model))
+        try:
+            return cv2.FaceDetectorYN.create(self.model, "", (320, 320),
+                                             score_threshold=DNN_SCORE_FLOOR)
+        except cv2.error as error:
+            raise ValueError("Cannot load the face model {}: {}"
+                             .format(self.model, error))
+
+    def _detector(self):
+        detector = getattr(self.local, 'detector', None)
+        if detector is None:
+            detector = self._create_detector()
+            self.local.detector = detector
+
+        return detector
+
+    # Score of the best face found in the image bytes 'data', or None if no
+    # face is found at all.
+    def score(self, data):
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        detector = self._detector()
+
+        if self.model is None:
+            gray = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+            faces, levels, weights = detector.detectMultiScale3(
+                gray, scaleFactor=1.1, minNeighbors=3,
+                minSize=(MIN_FACE, MIN_FACE), outputRejectLevels=True)
+            if len(faces) == 0:
+                return None
+            return float(np.max(weights))
+
+        image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_COLOR_2)
+        detector.setInputSize((image.shape[1], image.shape[0]))
+        retval, faces = detector.detect(image)
+        if faces is None or len(faces) == 0:
+            return None
+        # The last column of each detection is its confidence
+        return float(faces[:, -1].max())
+
+    # True if the image bytes 'data' may have a face in them
+    def has_faces(self, data):
+        score = self.score(data)
+
+        return score is not None and score >= self.threshold
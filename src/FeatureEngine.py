@@ -0,0 +1,93 @@
+import cv2
+
+
+# This class holds the intermediate arrays the OpenCV metrics of one image are
+# built on (decoded BGR, gray, HSV, float BGR, edges). Each intermediate is
+# computed the first time a metric asks for it and then kept, so an image is
+# decoded, or converted to gray or HSV, at most once however many metrics need
+# it. 'load' is a function returning the decoded BGR image.
+#
+# Metrics are registered with the names of the intermediates they depend on
+# and 'run()' evaluates them, in registration order, over the shared cache.
+# With an ImageStats ('stats'), the time of each metric is recorded as
+# 'metric.NAME' and that of each conversion as 'convert.NAME'.
+class FeatureEngine:
+    def __init__(self, load, stats=None):
+        self.load = load
+        self.stats = stats
+        self.cache = {}
+        self.metrics = []
+
+        # Functions used to build each intermediate. A builder may ask the
+        # engine for other intermediates, e.g. 'edges' is built from 'gray'.
+        self.builders = {
+            'bgr': self._bgr,
+            'bgr_float': self._bgr_float,
+            'gray': self._gray,
+            'hsv': self._hsv,
+            'edges': self._edges,
+        }
+
+    # Return the intermediate called 'name', computing it on first use.
+    def get(self, name):
+        if name not in self.cache:
+            if name not in self.builders:
+                raise KeyError("Unknown intermediate: {}".format(name))
+            # Decoding ('bgr') is timed by whoever supplies 'load'
+            if self.stats is None or name == 'bgr':
+                self.cache[name] = self.builders[name]()
+            else:
+                with self.stats.timed('convert.' + name):
+                    self.cache[name] = self.builders[name]()
+
+        return self.cache[name]
+
+    # Add a metric. 'function' is called with the engine and reads whatever it
+    # needs through its 'get()'; 'requires' lists the intermediates it will
+    # ask for.
+    def register(self, name, function, requires=()):
+        for intermediate in requires:
+            if intermediate not in self.builders:
+                raise KeyError("Metric {} requires unknown intermediate: {}"
+                               .format(name, intermediate))
+        self.metrics.append((name, function, tuple(requires)))
+
+    # Evaluate every registered metric and return a list of (name, value)
+    # pairs in registration order. The cache is dropped afterwards so the
+    # intermediates do not outlive the image they were computed from.
+    def run(self):
+        results = []
+        for name, function, requires in self.metrics:
+            for intermediate in requires:
+                self.get(intermediate)
+            if self.stats is None:
+                results.append((name, function(self)))
+            else:
+                with self.stats.timed('metric.' + name):
+                    results.append((name, function(self)))
+        self.release()
+
+        return results
+
+    # Forget all cached intermediates.
+    def release(self):
+        self.cache = {}
+
+    def _bgr(self):
+        return self.load()
+
+    def _bgr_float(self):
+        return self.get('bgr').astype("float")
+
+    def _gray(self):
+        return cv2.cvtColor(self.get('bgr'), cv2.COLOR_BGR2GRAY)
+
+    def _hsv(self):
+        return cv2.cvtColor(self.get('bgr'), cv2.COLOR_BGR2HSV)
+
+    # Edges are detected on a half size copy of the gray image, which is what
+    # the line count has always been measured on.
+    def _edges(self):
+        re_sized = cv2.resize(self.get('gray'), (0, 0), fx=0.5, fy=0.5)
+
+        return cv2.Canny(re_sized, 50, 150, apertureSize=3)
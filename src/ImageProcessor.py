@@ -1,14 +1,90 @@
 import io
 import cv2
-import math
-import requests
+import json
+import threading
 import numpy as np
-import cognitive_face
-from scipy.ndimage.filters import generic_filter
 
-from google.cloud import vision
-from google.cloud.vision import types
-from google.cloud.vision import enums
+from src.DominantColour import AZURE_NAMER, BASIC_NAMER
+from src.FeatureEngine import FeatureEngine
+from src.ResponseCache import ResponseCache
+from src.Telemetry import ImageStats
+from src.VisionBatcher import response_error
+
+
+# Default endpoint for the Microsoft Azure APIs. Can be pointed elsewhere (e.g.
+# a local stub server) with the 'azure_url' argument of ImageProcessor.
+AZURE_URL = 'https://australiaeast.api.cognitive.microsoft.com/'
+
+# Features and API versions requested from each provider. Together with the
+# image content these make up the key of a cached response (see
+# ResponseCache), so changing one of them invalidates the cached responses.
+GOOGLE_FEATURES = 'LABEL_DETECTION'
+GOOGLE_VERSION = 'v1'
+FACE_ATTRIBUTES = 'age,gender,smile,emotion'
+FACE_VERSION = 'v1.0'
+CV_FEATURES = 'Categories,Description,Color'
+CV_VERSION = 'v2.0'
+
+# Side of the square neighbourhood 'smooth()' measures around each pixel
+SMOOTH_WINDOW = 3
+
+# Session shared by every ImageProcessor that is not given one, so connections
+# to the Azure endpoint are kept alive between images.
+_session = None
+
+# Google Vision client shared by every ImageProcessor in this process. Building
+# a client loads 'key.json' and opens a gRPC channel, so it is done only once.
+_client = None
+_client_lock = threading.Lock()
+
+
+# Stages of the analysis of an image: the request to each provider, with the
+# ImageProcessor method making it, and the OpenCV metrics ('local'). Their
+# results make up the response list of 'detect_all()' in this order, and any
+# of them may be left out of a run (see Pipeline), their place in the list
+# then holding None. The Google client and requests are only imported when a
+# stage using them runs, so a run of the local stage alone starts quickly and
+# needs neither those packages nor credentials.
+REMOTE_STAGES = [
+    ('google', 'google_request'),
+    ('face', 'microsoft_face_request'),
+    ('cv', 'microsoft_cv_request'),
+]
+STAGES = [stage for stage, method in REMOTE_STAGES] + ['local']
+
+# Stages run unless others are asked for; the dominant colours the CV API
+# was used for are computed locally (see DominantColour)
+DEFAULT_STAGES = ['google', 'face', 'local']
+
+# OpenCV metrics run by 'detect_all()', in the order their results are added
+# to the response list, together with the intermediates (see FeatureEngine)
+# each one reads. A new metric only has to be added here and pays nothing for
+# the conversions the other metrics have already done.
+#
+# The last field says whether the metric is a global statistic that may be
+# computed on a reduced resolution proxy of the image (see 'proxy_scale').
+# Line counts and smoothness depend on fine detail and always use the full
+# resolution image.
+LOCAL_METRICS = [
+    ('colourfulness', 'image_colorfulness', ('bgr_float',), True),
+    ('lines', 'number_of_lines', ('edges',), False),
+    ('smooth', 'smooth', ('gray',), False),
+    ('saturation', 'saturation', ('hsv',), True),
+    ('brightness', 'brightness', ('gray',), True),
+    ('contrast', 'contrast_of_brightness', ('gray',), True),
+    ('clarity', 'image_clarity', ('gray',), True),
+    ('hue', 'warm_hue', ('hsv',), True),
+    ('balance', 'visual_balance_color', ('bgr_float',), True),
+    ('colours', 'dominant_colours', ('bgr',), True),
+]
+
+# Proxy scales and the OpenCV flags decoding a JPEG directly at that fraction
+# of its size
+PROXY_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
 
 
 # This class is responsible for obtaining/parsing information received from
@@ -16,19 +92,143 @@ from google.cloud.vision import enums
 # images using OpenCV. The features obtained from the APIs and OpenCV
 # processing will be used in regression analysis.
 class ImageProcessor:
-    def __init__(self, path):
+    def __init__(self, path, azure_url=AZURE_URL, session=None, batcher=None,
+                 cache=None, smooth_window=SMOOTH_WINDOW, proxy_scale=1,
+                 data=None, stats=None, face_prefilter=None,
+                 schedulers=None):
         self.path = path
-        self.client = vision.ImageAnnotatorClient.\
-            from_service_account_json('key.json')
-        self.opened_file = io.open(self.path, 'rb').read()
-        self.opened_file_cv2 = cv2.imread(path)
-        self.image = vision.types.Image(content=self.opened_file)
+        self.smooth_window = smooth_window
+        self.proxy_scale = proxy_scale
+        self._session = session
+
+        # Optional VisionBatcher which groups the Google requests of many
+        # images into one batch_annotate_images call
+        self.batcher = batcher
+
+        # Optional FacePrefilter; images it finds no face in are not sent to
+        # the Face API
+        self.face_prefilter = face_prefilter
+
+        # Optional RequestSchedulers by provider ('google', 'face', 'cv')
+        # keeping the requests within each provider's quota
+        self.schedulers = schedulers or {}
+
+        # Optional ResponseCache holding API responses from earlier runs
+        self.cache = cache
+        self._content_hash = None
+
+        # The image file is read once. The same bytes are sent to the APIs,
+        # hashed for the cache and decoded by OpenCV (see 'decode()'). 'data'
+        # can hold them when the caller has already read the file.
+        self.opened_file = data if data is not None else read_image(path)
+        self._image = None
         self.microsoft_key = ''
-        self.azure_url = 'https://australiaeast.api.cognitive.microsoft.com/'
-        self.vision_url = self.azure_url + 'vision/v2.0/analyze'
-        self.face_url = self.azure_url + 'face/v1.0/'
+        self.azure_url = azure_url
+        self.vision_url = self.azure_url + 'vision/' + CV_VERSION + '/analyze'
+        self.face_url = self.azure_url + 'face/' + FACE_VERSION + '/'
+
+        # Time spent in each stage of this image's analysis and counts of
+        # cache hits and API errors (see Telemetry)
+        self.stats = stats if stats is not None else ImageStats()
+
+        # Register the OpenCV metrics so they share gray/HSV/etc. conversions.
+        # The image is only decoded once a metric needs it. With a
+        # 'proxy_scale' above 1 the global metrics run on a second engine
+        # whose image is decoded at 1/proxy_scale of the full size.
+        self.engine = FeatureEngine(lambda: self.decode(cv2.IMREAD_COLOR),
+                                    stats=self.stats)
+        self.proxy_engine = self.engine
+        if proxy_scale != 1:
+            if proxy_scale not in PROXY_FLAGS:
+                raise ValueError("Proxy scale must be 1, 2, 4 or 8, not {}"
+                                 .format(proxy_scale))
+            self.proxy_engine = FeatureEngine(
+                lambda: self.decode(PROXY_FLAGS[proxy_scale]),
+                stats=self.stats)
+        for name, method, requires, proxy in LOCAL_METRICS:
+            engine = self.proxy_engine if proxy else self.engine
+            engine.register(name, getattr(self, method), requires)
+
+    # The Vision client is only built the first time a Google request is made,
+    # so the OpenCV metrics can be computed without credentials (e.g. in a
+    # worker process).
+    @property
+    def client(self):
+        return vision_client()
+
+    # Session the Azure requests are made with; the shared one (see
+    # 'default_session()') unless one was given
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = default_session()
+
+        return self._session
+
+    # Decoded image, see FeatureEngine
+    @property
+    def opened_file_cv2(self):
+        return self.engine.get('bgr')
+
+    # Image for the Google Vision client's single-feature requests
+    @property
+    def image(self):
+        from google.cloud.vision import types
+
+        if self._image is None:
+            self._image = types.Image(content=self.opened_file)
+
+        return self._image
+
+    # Decode the image bytes with the cv2.IMREAD_* 'flags'. np.frombuffer
+    # wraps the bytes without copying them.
+    def decode(self, flags):
+        with self.stats.timed('decode'):
+            return cv2.imdecode(np.frombuffer(self.opened_file,
+                                              dtype=np.uint8), flags)
+
+    # Return the response of 'provider' stored in the cache (bytes), or None
+    # when there is no cache or it does not hold one.
+    def cache_get(self, provider, features, version):
+        if self.cache is None:
+            return None
+        if self._content_hash is None:
+            self._content_hash = ResponseCache.content_hash(self.opened_file)
+
+        value = self.cache.get(self._content_hash, provider, features,
+                               version)
+        if value is None:
+            self.stats.count('cache_misses.' + provider)
+        else:
+            self.stats.count('cache_hits.' + provider)
+
+        return value
+
+    # Store the response of 'provider' (bytes) in the cache, if there is one.
+    def cache_put(self, provider, features, version, value):
+        if self.cache is None:
+            return
+        if self._content_hash is None:
+            self._content_hash = ResponseCache.content_hash(self.opened_file)
+
+        self.cache.put(self._content_hash, provider, features, version, value)
+
+    # Send a request to 'provider' by calling 'function', through the
+    # provider's RequestScheduler if there is one, and return its result.
+    def send(self, provider, function):
+        scheduler = self.schedulers.get(provider)
+        if scheduler is None:
+            return function()
+
+        return scheduler.call(function)
 
     def google_request(self):
+        from google.cloud.vision import enums, types
+
+        cached = self.cache_get('google', GOOGLE_FEATURES, GOOGLE_VERSION)
+        if cached is not None:
+            return types.AnnotateImageResponse.FromString(cached)
+
         # Possible features:
         # LABEL_DETECTION, FACE_DETECTION, LOGO_DETECTION, TEXT_DETECTION,
         # DOCUMENT_TEXT_DETECTION, SAFE_SEARCH_DETECTION, WEB_DETECTION,
@@ -37,19 +237,63 @@ class ImageProcessor:
             types.Feature(type=enums.Feature.Type.LABEL_DETECTION),
         ]
 
-        api_requests = []
-        image = types.Image(content=self.opened_file)
-
-        request = types.AnnotateImageRequest(image=image, features=features)
-        api_requests.append(request)
+        request = types.AnnotateImageRequest(image=self.image,
+                                             features=features)
+
+        def annotate():
+            response = self.client.batch_annotate_images(
+                [request]).responses[0]
+            error = response_error(response)
+            if error is not None:
+                raise error
+            return response
+
+        # Returns the AnnotateImageResponse of this image. A response with
+        # an error is raised rather than cached, so a later run asks again.
+        with self.stats.timed('google'):
+            if self.batcher is not None:
+                response = self.batcher.annotate(request)
+            else:
+                response = self.send('google', annotate)
+        self.cache_put('google', GOOGLE_FEATURES, GOOGLE_VERSION,
+                       response.SerializeToString())
 
-        return self.client.batch_annotate_images(api_requests)
+        return response
 
+    # Calls the Face API 'detect' endpoint directly (this is the request the
+    # cognitive_face package makes) so it can use the pooled session.
     def microsoft_face_request(self):
-        cognitive_face.Key.set(self.microsoft_key)
-        cognitive_face.BaseUrl.set(self.face_url)
-        attributes = 'age,gender,smile,emotion'
-        faces = cognitive_face.face.detect(self.path, attributes=attributes)
+        cached = self.cache_get('face', FACE_ATTRIBUTES, FACE_VERSION)
+        if cached is not None:
+            return json.loads(cached.decode('utf-8'))
+
+        # An image the pre-filter finds no face in gets the answer the Face
+        # API gives for such an image: no faces. It is not cached, as it is
+        # not the API's answer.
+        if self.face_prefilter is not None:
+            with self.stats.timed('face_prefilter'):
+                has_faces = self.face_prefilter.has_faces(self.opened_file)
+            if not has_faces:
+                self.stats.count('prefilter_skips.face')
+                return []
+
+        headers = {'Ocp-Apim-Subscription-Key': self.microsoft_key,
+                   'Content-Type': 'application/octet-stream'}
+        params = {'returnFaceId': 'false',
+                  'returnFaceAttributes': FACE_ATTRIBUTES}
+
+        def detect():
+            response = self.session.post(
+                self.face_url + 'detect', headers=headers, params=params,
+                data=self.opened_file)
+            response.raise_for_status()
+            return response
+
+        with self.stats.timed('face'):
+            response = self.send('face', detect)
+        faces = response.json()
+        self.cache_put('face', FACE_ATTRIBUTES, FACE_VERSION,
+                       response.content)
 
         # List of facial attributes we can get:
         # age, gender, headPose, smile, facialHair, glasses, emotion, hair,
@@ -69,18 +313,29 @@ class ImageProcessor:
         return faces
 
     def microsoft_cv_request(self):
+        cached = self.cache_get('cv', CV_FEATURES, CV_VERSION)
+        if cached is not None:
+            return json.loads(cached.decode('utf-8'))
+
         # Read the image into a byte array
         headers = {'Ocp-Apim-Subscription-Key': self.microsoft_key,
                    'Content-Type': 'application/octet-stream'}
-        params = {'visualFeatures': 'Categories,Description,Color'}
-        response = requests.post(
-            self.vision_url, headers=headers, params=params,
-            data=self.opened_file)
-        response.raise_for_status()
+        params = {'visualFeatures': CV_FEATURES}
+
+        def analyze():
+            response = self.session.post(
+                self.vision_url, headers=headers, params=params,
+                data=self.opened_file)
+            response.raise_for_status()
+            return response
+
+        with self.stats.timed('cv'):
+            response = self.send('cv', analyze)
 
         # Analysis is a JSON object that contains:
         # Categories, color, description, requestId, metadata
         analysis = response.json()
+        self.cache_put('cv', CV_FEATURES, CV_VERSION, response.content)
         # print("Dominant foreground colour: {}".format(
         #     analysis['color']['dominantColorForeground']))
         # print("Dominant background colour: {}".format(
@@ -91,9 +346,12 @@ class ImageProcessor:
 
         return analysis
 
-    def image_colorfulness(self):
+    # The OpenCV metrics below read their intermediates from 'engine', the
+    # FeatureEngine they were registered with (full resolution or proxy). When
+    # called directly they use the full resolution engine.
+    def image_colorfulness(self, engine=None):
         # split the image into its respective RGB components
-        (B, G, R) = cv2.split(self.opened_file_cv2.astype("float"))
+        (B, G, R) = cv2.split((engine or self.engine).get('bgr_float'))
 
         # compute rg = R - G
         rg = np.absolute(R - G)
@@ -112,10 +370,8 @@ class ImageProcessor:
         # derive the "colorfulness" metric and return it
         return round(std_root + (0.3 * mean_root))
 
-    def number_of_lines(self):
-        gray = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2GRAY)
-        re_sized = cv2.resize(gray, (0, 0), fx=0.5, fy=0.5)
-        edges = cv2.Canny(re_sized, 50, 150, apertureSize=3)
+    def number_of_lines(self, engine=None):
+        edges = (engine or self.engine).get('edges')
         lines = cv2.HoughLines(edges, 1, np.pi / 180, 200)
 
         if lines is None:
@@ -123,41 +379,55 @@ class ImageProcessor:
         else:
             return len(lines)
 
-    def smooth(self):
-        # return the percentage of smooth areas"
-        gray = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2GRAY)
-        filtered_image = generic_filter(gray, np.std, size=3)
-        smooth_area = filtered_image == 0
+    # Return the percentage of smooth areas, i.e. pixels whose neighbourhood
+    # (a 'smooth_window' sized square) has a standard deviation below 1.
+    #
+    # The sum and sum of squares over every neighbourhood come from two box
+    # filters, which gives the local variance of all pixels at once:
+    # var = (n * sum(x^2) - sum(x)^2) / n^2. Comparing n^2 * var with n^2
+    # keeps everything in exact integer arithmetic, so this matches the old
+    # 'generic_filter(gray, np.std, size=3) == 0' without calling np.std for
+    # every pixel.
+    def smooth(self, engine=None):
+        gray = (engine or self.engine).get('gray').astype("float64")
+        size = (self.smooth_window, self.smooth_window)
+        n = self.smooth_window * self.smooth_window
+        sums = cv2.boxFilter(gray, -1, size, normalize=False,
+                             borderType=cv2.BORDER_REFLECT)
+        squares = cv2.sqrBoxFilter(gray, -1, size, normalize=False,
+                                   borderType=cv2.BORDER_REFLECT)
+        smooth_area = n * squares - sums * sums < n * n
         percent = np.count_nonzero(smooth_area) / smooth_area.size
 
         return round(percent, 2)
 
-    def saturation(self):
-        hsv = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2HSV)
+    def saturation(self, engine=None):
+        hsv = (engine or self.engine).get('hsv')
 
         # saturation is the s channel
         s = hsv[:, :, 1]
 
         return round(s.mean(), 2)
 
-    def brightness(self):
-        gray = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2GRAY)
+    def brightness(self, engine=None):
+        gray = (engine or self.engine).get('gray')
 
         return round(gray.mean(), 2)
 
-    def contrast_of_brightness(self):
-        gray = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2GRAY)
+    def contrast_of_brightness(self, engine=None):
+        gray = (engine or self.engine).get('gray')
 
         return round(gray.std(), 2)
 
-    def image_clarity(self):
-        gray = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2GRAY) / 255.0
-        bright = gray >= .7
+    def image_clarity(self, engine=None):
+        # Same as 'gray / 255.0 >= .7' without building a float copy
+        gray = (engine or self.engine).get('gray')
+        bright = gray >= .7 * 255
 
         return round(bright.sum() / bright.size, 2)
 
-    def warm_hue(self):
-        hsv = cv2.cvtColor(self.opened_file_cv2, cv2.COLOR_BGR2HSV)
+    def warm_hue(self, engine=None):
+        hsv = (engine or self.engine).get('hsv')
 
         # hue is the h channel
         h = hsv[:, :, 0]
@@ -165,97 +435,63 @@ class ImageProcessor:
 
         return round(warm.sum() / warm.size, 2)
 
-    def visual_balance_color(self):
-        mid = int(self.opened_file_cv2.shape[1] / 2)
-        left_half = np.array(self.opened_file_cv2[:, 0:mid, ], dtype='int')
-        right_half = np.flip(np.array(self.opened_file_cv2[:, mid:2 * mid, ],
-                                      dtype='int'), axis=1)
+    def visual_balance_color(self, engine=None):
+        image = (engine or self.engine).get('bgr_float')
+        mid = int(image.shape[1] / 2)
+        left_half = image[:, 0:mid, ]
+        right_half = np.flip(image[:, mid:2 * mid, ], axis=1)
         dif_square = np.square(left_half - right_half)
         euclidean = np.sqrt(dif_square.sum(axis=2))
 
         return round(-euclidean.mean(), 2)
 
-    def detect_all(self):
+    # (foreground, background) dominant colours, named as the Microsoft CV
+    # API names them, computed locally (see DominantColour)
+    def dominant_colours(self, engine=None):
+        return AZURE_NAMER.foreground_background(
+            (engine or self.engine).get('bgr'))
+
+    # Run the 'stages' (all of STAGES by default) and return the response
+    # list, holding None in place of the stages left out.
+    def detect_all(self, stages=None):
+        stages = STAGES if stages is None else stages
+        if 'local' in stages:
+            local_response = self.local_metrics()
+        else:
+            local_response = [None] * len(LOCAL_METRICS)
+
+        return self.remote_requests(stages) + local_response
+
+    # Query the Google and Microsoft APIs and return their responses as a
+    # list: [google, microsoft face, microsoft cv]. Providers not in
+    # 'stages' (all of them by default) are not queried and give None.
+    def remote_requests(self, stages=None):
         # Response list
         response = []
 
-        # Get information from Google Vision API
-        print("----- Return all information from Google Vision API -----")
-        google_response = self.google_request()
-        response.append(google_response)
-        # print(google_response)
-
-        # Get information from Microsoft Face API
-        print("----- Return all information from Microsoft Face API -----")
-        microsoft_face_response = self.microsoft_face_request()
-        response.append(microsoft_face_response)
-        # print(microsoft_face_response)
-
-        # Get information from Microsoft Computer Vision API
-        print("----- Return all information from Microsoft Object API -----")
-        microsoft_cv_response = self.microsoft_cv_request()
-        response.append(microsoft_cv_response)
-        # print(microsoft_cv_response)
-
-        # Use OpenCV to evaluate 'colourfulness' of an image
-        print("----- OpenCV: Colour evaluation -----")
-        colour_response = self.image_colorfulness()
-        response.append(colour_response)
-        # print(colour_response)
-
-        # Use OpenCV to determine how many lines are in an image
-        print("----- OpenCV: Line evaluation -----")
-        line_response = self.number_of_lines()
-        response.append(line_response)
-        # print(line_response)
-
-        # Use OpenCV to determine percentage of image that is 'smooth'
-        # print("----- OpenCV: Smoothness evaluation -----")
-        # smooth_response = self.smooth()
-        # response.append(smooth_response)
-        # print(smooth_response)
-
-        # Use OpenCV to determine the saturation of an image
-        print("----- OpenCV: Saturation evaluation -----")
-        sat_response = self.saturation()
-        response.append(sat_response)
-        # print(sat_response)
-
-        # Use OpenCV to determine the brightness of an image
-        print("----- OpenCV: Brightness evaluation -----")
-        bright_response = self.brightness()
-        response.append(bright_response)
-        # print(bright_response)
-
-        # Use OpenCV to determine the contrast of brightness of an image
-        print("----- OpenCV: Contrast of rightness evaluation -----")
-        cob_response = self.contrast_of_brightness()
-        response.append(cob_response)
-        # print(cob_response)
-
-        # Use OpenCV to determine the clarity of an image
-        print("----- OpenCV: Clarity evaluation -----")
-        clarity_response = self.image_clarity()
-        response.append(clarity_response)
-        # print(clarity_response)
-
-        # Use OpenCV to determine if an image has a 'warm' hue
-        print("----- OpenCV: Warm hue evaluation -----")
-        hue_response = self.warm_hue()
-        response.append(hue_response)
-        # print(hue_response)
-
-        # Use OpenCV to determine the colour balance of an image
-        print("----- OpenCV: Colour balance evaluation -----")
-        balance_response = self.visual_balance_color()
-        response.append(balance_response)
-        # print(balance_response)
-        print()
-
-        # return (google_response, microsoft_face_response, microsoft_cv_response,
-        #         colour_response, line_response, smooth_response, sat_response,
-        #         bright_response, cob_response, clarity_response, hue_response,
-        #         balance_response)
+        for stage, method in REMOTE_STAGES:
+            if stages is None or stage in stages:
+                response.append(getattr(self, method)())
+            else:
+                response.append(None)
+
+        return response
+
+    # Compute the OpenCV metrics and return their values as a list in the
+    # order of LOCAL_METRICS.
+    def local_metrics(self):
+        response = []
+
+        # Use OpenCV to evaluate the local metrics listed in LOCAL_METRICS
+        # (colourfulness, lines, smoothness, saturation, brightness,
+        # contrast, clarity, warm hue, colour balance and dominant colours).
+        # The engine converts the image to gray/HSV once and shares the
+        # result between the metrics.
+        values = dict(self.engine.run())
+        if self.proxy_engine is not self.engine:
+            values.update(self.proxy_engine.run())
+        for metric in LOCAL_METRICS:
+            response.append(values[metric[0]])
 
         return response
 
@@ -273,61 +509,67 @@ class ImageProcessor:
         # strategy.
         return False if len(faces) == 0 else True
 
-    # This function detects the dominant colours in a given image using the
-    # Google Cloud Vision API.
+    # This function names the dominant colour of a given image with the
+    # nearest of BASIC_COLOURS (see DominantColour).
     def detect_colours(self):
-        # print("Detecting colours in file: {}".format(self.path))
-        response = self.client.image_properties(image=self.image)
-        props = response.image_properties_annotation
-
-        # Sort dominant colours by 'score' property
-        props.dominant_colors.colors.sort(key=lambda col: col.score, reverse=True)
-
-        # Get the first element of sorted list i.e. element with highest score
-        tmp_colour = props.dominant_colors.colors[0]
-
-        red = tmp_colour.color.red
-        blue = tmp_colour.color.blue
-        green = tmp_colour.color.green
-
-        # Basic colour RGB values:
-        # https://www.rapidtables.com/web/color/RGB_Color.html
-        # basic_colours = [("red", 255, 0, 0), ("lime", 0, 255, 0),
-        #                  ("blue", 0, 0, 255), ("yellow", 255, 255, 0),
-        #                  ("cyan", 0, 255, 255), ("magenta", 255, 0, 255)]
-        # ("white", 0, 0, 0), ("black", 255, 255, 255),
-        basic_colours = [("red", 255, 0, 0), ("lime", 0, 255, 0),
-                         ("blue", 0, 0, 255), ("yellow", 255, 255, 0),
-                         ("cyan", 0, 255, 255), ("magenta", 255, 0, 255),
-                         ("silver", 192, 192, 192), ("gray", 128, 128, 128),
-                         ("maroon", 128, 0, 0), ("olive", 128, 128, 0),
-                         ("green", 0, 128, 0), ("purple", 128, 0, 128),
-                         ("teal", 0, 128, 128), ("navy", 0, 0, 128)]
-
-        # Max distance is between Black (0, 0, 0) and White (255, 255, 255).
-        # Therefore maximum distance is sqrt(3 * 255^2) = 442 so set dist to
-        # a value greater than 441.
-        dist = 1000
-        dominant_colour = ""
-        for colour in basic_colours:
-            tmp_red = colour[1]
-            tmp_green = colour[2]
-            tmp_blue = colour[3]
-            x = (red - tmp_red) ** 2
-            y = (green - tmp_green) ** 2
-            z = (blue - tmp_blue) ** 2
-            tmp_dist = math.sqrt(x + y + z)
-            if tmp_dist < dist:
-                dist = tmp_dist
-                dominant_colour = colour[0]
-
-        # Determine whether Red dominates Blue
-        # (dominant_colour, num) = \
-        #     ("Red", red) if red > blue else ("Blue", blue)
-        #
-        # Determine whether Green dominates the maximum of Red and Blue
-        # (dominant_colour, num) = \
-        #     ("Green", green) if green > num else (dominant_colour, num)
+        return BASIC_NAMER.dominant_colour(self.engine.get('bgr'))
+
+
+# Build a requests Session that keeps up to 'pool_size' connections per host
+# open, so concurrent requests reuse connections instead of opening new ones.
+def make_session(pool_size=10):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# Return the Google Vision client shared by all ImageProcessors, building it
+# on first use.
+def vision_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            from google.cloud import vision
+
+            _client = vision.ImageAnnotatorClient.\
+                from_service_account_json('key.json')
+
+    return _client
+
+
+# Return the session shared by ImageProcessors created without one.
+def default_session():
+    global _session
+    if _session is None:
+        _session = make_session()
+
+    return _session
+
+
+# Prepare a worker process for 'local_features()'. Each worker runs its own
+# image, so OpenCV's internal threading would only oversubscribe the cores.
+def init_worker():
+    cv2.setNumThreads(1)
+
+
+# Read the whole image file at 'path' in one go and return its bytes.
+def read_image(path):
+    with io.open(path, 'rb') as image_file:
+        return image_file.read()
+
 
-        return dominant_colour
+# Compute only the OpenCV metrics for the image at 'path' and return them
+# with the ImageStats of the work. This is a module level function so it can
+# be sent to a process pool. 'settings' are passed on to ImageProcessor (e.g.
+# 'smooth_window', or 'data' holding the image bytes so the worker does not
+# read the file again).
+def local_features(path, **settings):
+    image_processor = ImageProcessor(path, **settings)
 
+    return image_processor.local_metrics(), image_processor.stats
@@ -0,0 +1,91 @@
+import zlib
+import os
+
+import pandas as pd
+
+
+# Columns of the details CSV file used by the analysis
+DETAIL_COLUMNS = ['shortcode', 'edge_liked_by_count', 'user_followers',
+                  'user_posts', 'user_following']
+
+
+# This class works out, before any image is analysed, which rows of the
+# details CSV file have an image to analyse. The CSV is read in chunks with
+# only the columns we need, short-codes are cleaned up with vectorized string
+# operations, and the image directory is listed once instead of checking
+# every image path with its own 'os.path.isfile' call. The work plan is then
+# the rows whose image file is in that listing.
+#
+# With 'shards' above 1 only the rows of shard number 'shard' (0 to
+# shards - 1) are planned, see 'shard_of()'. Every row belongs to exactly one
+# shard, so N machines given the same details file can each take one.
+class InputPlanner:
+    def __init__(self, details_path, image_dir, chunk_rows=100000, shard=0,
+                 shards=1):
+        if not 0 <= shard < shards:
+            raise ValueError("Shard must be between 0 and {}, not {}"
+                             .format(shards - 1, shard))
+        self.details_path = details_path
+        self.image_dir = image_dir
+        self.chunk_rows = chunk_rows
+        self.shard = shard
+        self.shards = shards
+
+        # Number of rows in the details CSV (all shards), set by 'plan()'
+        self.rows = None
+
+    # Read the details CSV. The index is the row number in the file, which
+    # is what the output file names are based on.
+    def read_details(self):
+        chunks = []
+        for chunk in pd.read_csv(self.details_path, usecols=DETAIL_COLUMNS,
+                                 chunksize=self.chunk_rows):
+            # Some short-codes end with a stray "'" which is not part of the
+            # image name
+            short_code = chunk['shortcode'].astype(str)
+            chunk['short_code'] = short_code.where(
+                ~short_code.str.endswith("'"), short_code.str[:-1])
+            chunk['original_file_name'] = chunk['short_code'] + ".jpg"
+            chunks.append(chunk)
+
+        if not chunks:
+            return pd.DataFrame(
+                columns=DETAIL_COLUMNS + ['short_code', 'original_file_name'])
+
+        return pd.concat(chunks)
+
+    # Names of the regular files in the image directory
+    def list_images(self):
+        with os.scandir(self.image_dir) as entries:
+            return [entry.name for entry in entries if entry.is_file()]
+
+    # Return (plan, missing): the rows of the details CSV whose image exists,
+    # in file order and with an 'image_path' column, and the rows whose image
+    # does not.
+    def plan(self):
+        details = self.read_details()
+        self.rows = len(details)
+        if self.shards > 1:
+            details = details[details['short_code'].map(
+                lambda short_code: shard_of(short_code, self.shards)) ==
+                self.shard]
+        images = pd.DataFrame({'original_file_name': self.list_images(),
+                               'found': True})
+
+        joined = details.reset_index().merge(
+            images, on='original_file_name', how='left').set_index('index')
+        joined.index.name = None
+        found = joined['found'].notna()
+
+        plan = joined[found].drop(columns='found')
+        plan['image_path'] = os.path.join(self.image_dir, '') + \
+            plan['original_file_name']
+        missing = joined.loc[~found, ['short_code']]
+
+        return plan, missing
+
+
+# Shard (0 to shards - 1) of the row with the (cleaned up) 'short_code'. CRC32
+# gives the same answer on every machine and Python version, unlike hash().
+def shard_of(short_code, shards):
+    return zlib.crc32(short_code.encode('utf-8')) % shards
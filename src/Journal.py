@@ -0,0 +1,80 @@
+import json
+import os
+
+
+# Convert NumPy scalars (e.g. the OpenCV metrics) to plain Python values so
+# they can be stored as JSON.
+def _to_json(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError("Cannot store {!r} in the journal".format(value))
+
+
+# This class keeps a work journal of a run: every finished image is appended
+# to a JSON-lines file, together with its row number, short-code, output row
+# and perceptual hash (with '--dedup'), as soon as its analysis is done. If a
+# run crashes (or hits an API quota) a new run started with 'resume' reads
+# the journal back, skips the images already finished and adds the rest to
+# the same journal. 'compact()' then writes every row in row order, which
+# gives the same output file as an uninterrupted run.
+class Journal:
+    def __init__(self, path, resume=False):
+        self.path = path
+
+        # Finished rows by row number: {index: (short_code, row)}
+        self.done = {}
+
+        # Perceptual hashes of the finished rows that have one, by row number
+        self.hashes = {}
+        if resume and os.path.isfile(path):
+            self.load()
+
+        # A fresh run starts a new journal
+        self.handle = open(path, 'a' if resume else 'w')
+
+    # Read the finished rows back. The last line may be cut short if the run
+    # crashed while writing it; it is ignored and cut off the file so new
+    # entries start on a line of their own.
+    def load(self):
+        complete = 0
+        with open(self.path, 'rb') as handle:
+            for line in handle:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                self.done[entry['index']] = (entry['short_code'],
+                                             tuple(entry['row']))
+                if entry.get('hash') is not None:
+                    self.hashes[entry['index']] = entry['hash']
+                complete += len(line)
+
+        with open(self.path, 'r+b') as handle:
+            handle.truncate(complete)
+
+    # True if the image in row 'index' with 'short_code' was already finished
+    def is_done(self, index, short_code):
+        entry = self.done.get(index)
+        return entry is not None and entry[0] == short_code
+
+    # Record a finished image, with its perceptual hash 'image_hash' if it
+    # has one. The entry is on disk before this returns.
+    def record(self, index, short_code, row, image_hash=None):
+        self.done[index] = (short_code, tuple(row))
+        entry = {'index': index, 'short_code': short_code, 'row': list(row)}
+        if image_hash is not None:
+            self.hashes[index] = image_hash
+            entry['hash'] = image_hash
+        self.handle.write(json.dumps(entry, default=_to_json) + "\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    # Write every finished row, in row order, to 'writer' (an OutputWriter).
+    def compact(self, writer):
+        for index in sorted(self.done):
+            writer.write(self.done[index][1])
+
+    def close(self):
+        self.handle.close()
@@ -0,0 +1,111 @@
+import json
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Number of label values read from the labels CSV at a time while building
+# the index, whatever its width
+BUILD_CELLS = 10 * 1000 * 1000
+
+# Format of the index files. An index of another version is rebuilt.
+INDEX_VERSION = 2
+
+
+# This class answers the one question main.py asks of the labels CSV: the
+# largest label value of an image file. The labels CSV has one column per
+# image file, so loading it takes time and memory that grow with the number
+# of images. Instead its column maxima are computed once and stored as an
+# index at 'index_path' (next to the CSV by default): a NumPy file with one
+# (file name, maximum) record per column, which is memory-mapped when
+# opened. The maxima are float64, as
+# pandas reads the CSV, so comparing them with a threshold gives the same
+# answer as comparing the CSV values. A small JSON file records the path,
+# size and modification time of the CSV the index was built from, and the
+# index is rebuilt when it is given another CSV or the CSV changes.
+#
+# Missing and non-numeric values (e.g. a column of label names) are ignored;
+# a column without any number has a maximum of NaN (which is not greater
+# than anything). If a file name appears in more than one column, its first
+# column is used, as pandas would.
+class LabelIndex:
+    def __init__(self, labels_path, index_path=None):
+        self.labels_path = labels_path
+        self.index_path = index_path or labels_path + '.index.npy'
+        self.meta_path = os.path.splitext(self.index_path)[0] + '.json'
+
+        if not self.is_current():
+            self.build()
+        self.load()
+
+    # Path, size and modification time of the labels CSV
+    def source(self):
+        status = os.stat(self.labels_path)
+        return {'path': os.path.abspath(self.labels_path),
+                'size': status.st_size, 'mtime': status.st_mtime,
+                'version': INDEX_VERSION}
+
+    # True if the index exists and was built from the current labels CSV
+    def is_current(self):
+        if not os.path.isfile(self.index_path) or \
+                not os.path.isfile(self.meta_path):
+            return False
+        with open(self.meta_path) as meta_file:
+            return json.load(meta_file) == self.source()
+
+    # Compute the maximum of every column of the labels CSV and store them
+    def build(self):
+        with open(self.labels_path, newline='') as labels_file:
+            names = next(csv.reader(labels_file), [])
+
+        maxima = np.full(len(names), np.nan, dtype=np.float64)
+        chunks = []
+        if names:
+            try:
+                chunks = pd.read_csv(
+                    self.labels_path, header=None, skiprows=1,
+                    chunksize=max(1, BUILD_CELLS // len(names)))
+            except pd.errors.EmptyDataError:
+                pass
+        for chunk in chunks:
+            # Values that are not numbers become NaN, which fmax ignores
+            # unless both values are NaN
+            values = chunk.apply(pd.to_numeric, errors='coerce').values
+            maxima = np.fmax(maxima, np.fmax.reduce(
+                values.astype(np.float64), axis=0))
+
+        width = max([len(name.encode('utf-8')) for name in names] + [1])
+        index = np.empty(len(names), dtype=[('name', 'S{}'.format(width)),
+                                            ('max', np.float64)])
+        index['name'] = [name.encode('utf-8') for name in names]
+        index['max'] = maxima
+
+        # Written under a temporary name first, so a crash never leaves a
+        # half written index that looks current
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'wb') as index_file:
+            np.save(index_file, index)
+        os.replace(temporary, self.index_path)
+        with open(self.meta_path, 'w') as meta_file:
+            json.dump(self.source(), meta_file)
+
+    def load(self):
+        self.index = np.load(self.index_path, mmap_mode='r')
+
+        # Position of each file name in the index; the first column wins
+        self.positions = {}
+        for position, name in enumerate(self.index['name']):
+            self.positions.setdefault(name.decode('utf-8'), position)
+
+    # Largest label value of the image 'file_name'. Raises KeyError if the
+    # labels CSV has no column for it.
+    def maximum(self, file_name):
+        return float(self.index['max'][self.positions[file_name]])
+
+    def __contains__(self, file_name):
+        return file_name in self.positions
+
+    def __len__(self):
+        return len(self.positions)
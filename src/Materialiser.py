@@ -0,0 +1,173 @@
+import concurrent.futures
+import threading
+import hashlib
+import shutil
+import csv
+import os
+
+
+# Ways of putting the renamed copy of each image in the output image
+# directory (see Materialiser)
+STRATEGIES = ['copy', 'hardlink', 'symlink', 'reflink', 'manifest']
+
+# Linux ioctl asking the file system to share the blocks of one file with
+# another (copy-on-write), as 'cp --reflink' does
+FICLONE = 0x40049409
+
+
+# This class produces the output image directory, where every image is
+# available as 'ROW_NUMBER.jpg', without holding up the analysis. Images are
+# handed over with 'submit()' and materialised by a background thread using
+# one of these strategies:
+#
+#   copy      write the bytes the pipeline has already read to a new file
+#   hardlink  link the new name to the original file (no data is written)
+#   symlink   symbolic link to the original file
+#   reflink   copy-on-write clone of the original file where the file system
+#             supports it, otherwise an in-kernel 'copy_file_range' copy
+#   manifest  no files at all, only the manifest
+#
+# Whatever the strategy, every image is listed in a manifest CSV file with
+# its output name, source path, size and SHA-256, and 'verify()' checks the
+# output against it.
+class Materialiser:
+    def __init__(self, image_dir, manifest_path, strategy='copy',
+                 append=False, max_pending=16):
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown materialise strategy: {}"
+                             .format(strategy))
+        self.image_dir = image_dir
+        self.strategy = strategy
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.errors = []
+
+        # Images waiting to be written keep their bytes in memory, so only
+        # 'max_pending' may wait at a time
+        self.pending = threading.Semaphore(max_pending)
+        self.lock = threading.Lock()
+
+        # 'append' adds to the manifest of an earlier (resumed) run
+        self.manifest_path = manifest_path
+        new_manifest = not (append and os.path.isfile(manifest_path))
+        self.manifest = open(manifest_path, 'w' if new_manifest else 'a',
+                             newline='')
+        self.manifest_writer = csv.writer(self.manifest)
+        if new_manifest:
+            self.manifest_writer.writerow(['file_name', 'source', 'size',
+                                           'sha256'])
+
+    # Materialise the image at 'source' as 'name'. 'data' holds its bytes.
+    # Blocks while 'max_pending' images are already waiting. Returns a
+    # future that is done once the image and its manifest row are written.
+    def submit(self, source, name, data):
+        self.pending.acquire()
+        future = self.executor.submit(self._materialise, source, name, data)
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def _materialise(self, source, name, data):
+        dest = os.path.join(self.image_dir, name)
+        if self.strategy != 'manifest' and os.path.lexists(dest):
+            os.remove(dest)
+
+        if self.strategy == 'copy':
+            with open(dest, 'wb') as output_file:
+                output_file.write(data)
+        elif self.strategy == 'hardlink':
+            try:
+                os.link(source, dest)
+            except OSError:
+                # e.g. the output is on another file system
+                shutil.copyfile(source, dest)
+        elif self.strategy == 'symlink':
+            os.symlink(os.path.abspath(source), dest)
+        elif self.strategy == 'reflink':
+            clone_file(source, dest)
+
+        # Flushed row by row, so the manifest lists every image written even
+        # if the run crashes (see 'verify()')
+        with self.lock:
+            self.manifest_writer.writerow(
+                [name, source, len(data), hashlib.sha256(data).hexdigest()])
+            self.manifest.flush()
+
+    # Check every image in the manifest. With 'check_hash' the content of
+    # each output file is hashed and compared, otherwise only its size.
+    # Returns the list of problems found.
+    def verify(self, check_hash=False):
+        problems = []
+        with open(self.manifest_path, newline='') as manifest:
+            for entry in csv.DictReader(manifest):
+                path = entry['source']
+                if self.strategy != 'manifest':
+                    path = os.path.join(self.image_dir, entry['file_name'])
+
+                if not os.path.isfile(path):
+                    problems.append("{}: missing".format(path))
+                elif os.path.getsize(path) != int(entry['size']):
+                    problems.append("{}: wrong size".format(path))
+                elif check_hash and file_hash(path) != entry['sha256']:
+                    problems.append("{}: content differs".format(path))
+
+        return problems
+
+    # Wait for every image to be materialised. Errors raised by the
+    # background thread are raised here.
+    def close(self):
+        self.executor.shutdown()
+        self.manifest.close()
+        if self.errors:
+            raise self.errors[0]
+
+
+# Clone 'source' to 'dest' with a reflink if the file system supports it,
+# otherwise copy it inside the kernel with copy_file_range, otherwise copy it.
+# Reflinks need 'fcntl', which Windows does not have.
+def clone_file(source, dest):
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+
+    with open(source, 'rb') as source_file, open(dest, 'wb') as dest_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dest_file.fileno(), FICLONE,
+                            source_file.fileno())
+                return
+            except OSError:
+                pass
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(source_file.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(source_file.fileno(),
+                                                dest_file.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            dest_file.seek(0)
+            dest_file.truncate()
+            source_file.seek(0)
+
+        shutil.copyfileobj(source_file, dest_file)
+
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(1024 * 1024), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
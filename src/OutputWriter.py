@@ -0,0 +1,95 @@
+import time
+import os
+
+import pandas as pd
+
+
+# File formats OutputWriter can write, by file extension
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.feather': 'feather'}
+
+
+# This class writes the rows of the output file as they are produced instead
+# of rebuilding and rewriting the whole file for every new row. Rows are kept
+# in a small buffer and appended to the file in chunks of 'chunk_rows' rows,
+# or sooner if 'flush_seconds' have passed since the last write, so the file
+# on disk is never far behind. Every chunk is fsync'd after it is written.
+#
+# CSV files are written with pandas exactly like DataFrame.to_csv() would.
+# Parquet and Feather files need pyarrow and are written one row group/record
+# batch per chunk.
+class OutputWriter:
+    def __init__(self, path, columns, dtypes=None, chunk_rows=500,
+                 flush_seconds=30):
+        self.path = path
+        self.columns = columns
+
+        # Column types that should not be guessed from a single chunk (e.g. a
+        # float column whose first chunk only holds ints), so every chunk is
+        # written the same way.
+        self.dtypes = dtypes or {}
+        self.chunk_rows = chunk_rows
+        self.flush_seconds = flush_seconds
+        self.format = FORMATS.get(os.path.splitext(path)[1].lower())
+        if self.format is None:
+            raise ValueError("Unsupported output format: {}".format(path))
+
+        self.rows = []
+        self.rows_written = 0
+        self.last_flush = time.time()
+        if self.format == 'csv':
+            self.handle = open(path, 'w', newline='')
+        else:
+            self.handle = open(path, 'wb')
+        self.writer = None
+        self.schema = None
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_rows or \
+                time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    # Append the buffered rows to the file and make sure they reach the disk.
+    # With 'final' an empty file still gets its header/schema.
+    def flush(self, final=False):
+        if not self.rows and (self.rows_written > 0 or not final):
+            return
+
+        frame = pd.DataFrame(self.rows, columns=self.columns)
+        if self.dtypes:
+            frame = frame.astype(self.dtypes)
+
+        if self.format == 'csv':
+            frame.to_csv(self.handle, header=(self.rows_written == 0),
+                         index=None)
+        else:
+            self._write_arrow(frame)
+
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.rows_written += len(self.rows)
+        self.rows = []
+        self.last_flush = time.time()
+
+    def _write_arrow(self, frame):
+        import pyarrow as pa
+
+        if self.writer is None:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            self.schema = table.schema
+            if self.format == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.handle, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.handle, self.schema)
+        else:
+            table = pa.Table.from_pandas(frame, schema=self.schema,
+                                         preserve_index=False)
+
+        self.writer.write_table(table)
+
+    def close(self):
+        self.flush(final=True)
+        if self.writer is not None:
+            self.writer.close()
+        self.handle.close()
@@ -0,0 +1,304 @@
+import concurrent.futures
+import collections
+import functools
+import asyncio
+import time
+import os
+
+from src.ImageProcessor import ImageProcessor, AZURE_URL, DEFAULT_STAGES, \
+    LOCAL_METRICS, REMOTE_STAGES, local_features, make_session, read_image, \
+    vision_client
+from src.DuplicateIndex import dhash
+from src.RequestScheduler import RequestScheduler
+from src.Telemetry import ImageStats
+from src.VisionBatcher import VisionBatcher
+
+
+# This class runs the analysis of many images on an asyncio event loop. For
+# each image the Google, Microsoft Face and Microsoft CV requests are sent at
+# the same time, and the OpenCV metrics run alongside them in an executor. Up
+# to 'in_flight' images are analysed at once, and results are handed back in
+# the order the images were given.
+#
+# Requests go through one pooled requests Session, so connections to the
+# Azure endpoint are reused instead of opened for every call, and Google
+# label requests of the images in flight are sent together in batches.
+#
+# The ImageStats of every image (time per stage, cache hits, API errors) are
+# handed to 'telemetry' (see Telemetry), if one is given.
+#
+# The response list of every image is reduced with 'summarise' (e.g. to the
+# output columns it gives) before it is handed back; by default it is kept
+# whole.
+#
+# With a DuplicateIndex ('duplicates') an image whose perceptual hash is
+# close enough to that of an earlier image is not analysed: it gets the
+# summary of that earlier (canonical) image. Images are looked up in and
+# added to the index in the order of the jobs, so the canonical image is
+# always the first of its duplicates, however the analysis is scheduled.
+# Only the summaries of canonical images are kept for their duplicates, so
+# 'summarise' should keep them small. Canonical images analysed by an
+# earlier run (see '--resume') are added with 'add_canonical()'.
+#
+# Every provider's requests go through a RequestScheduler, which keeps to
+# the provider's rate in 'rates' (requests, or for Google images, per second;
+# no limit if missing) and retries throttled and failed requests up to
+# 'max_retries' times. While a provider is throttled its requests wait in the
+# I/O threads, and the OpenCV metrics carry on in threads of their own.
+#
+# Only the 'stages' (see STAGES in ImageProcessor) are run, DEFAULT_STAGES
+# unless given; the place of every other stage in the response list holds
+# None. The dominant colours are computed locally (see DominantColour), so
+# the Microsoft CV API is not called by default.
+class Pipeline:
+    def __init__(self, materialiser, in_flight=1, local_executor=None,
+                 azure_url=None, cache=None, local_settings=None,
+                 telemetry=None, face_prefilter=None, duplicates=None,
+                 rates=None, max_retries=5, stages=None, summarise=None):
+        self.in_flight = max(1, in_flight)
+        self.azure_url = azure_url or AZURE_URL
+
+        # Optional ResponseCache and FacePrefilter shared by all images
+        self.cache = cache
+        self.face_prefilter = face_prefilter
+
+        # Stages run, and the providers every image is sent to
+        self.stages = list(DEFAULT_STAGES if stages is None else stages)
+        self.providers = [stage for stage, method in REMOTE_STAGES
+                          if stage in self.stages]
+
+        # Each image makes up to three blocking API requests at once. The
+        # session (and with it requests) is only needed for the Azure APIs.
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=3 * self.in_flight)
+        self.session = None
+        if 'face' in self.providers or 'cv' in self.providers:
+            self.session = make_session(pool_size=2 * self.in_flight)
+
+        rates = rates or {}
+        self.schedulers = {provider: RequestScheduler(
+                               provider, rate=rates.get(provider),
+                               max_retries=max_retries)
+                           for provider in self.providers}
+        self.batcher = None
+        if 'google' in self.providers:
+            self.batcher = VisionBatcher(
+                vision_client, max_batch=self.in_flight,
+                scheduler=self.schedulers['google'])
+
+        # OpenCV metrics run in 'local_executor' (e.g. a process pool) when one
+        # is given and in a thread pool of their own otherwise, so requests
+        # waiting for a provider never hold them up. There is no point in
+        # more threads than cores, and each one holds a decoded image.
+        self.local_executor = local_executor
+        self.local_threads = None
+        if local_executor is None:
+            self.local_threads = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(self.in_flight, os.cpu_count() or 1))
+
+        # Settings of the OpenCV metrics (e.g. 'smooth_window'), passed on to
+        # every ImageProcessor
+        self.local_settings = local_settings or {}
+
+        # Materialiser putting the renamed images in the output directory
+        self.materialiser = materialiser
+
+        # The schedulers' retries and throttling are counted per provider,
+        # not per image, so telemetry reads their counters directly
+        self.telemetry = telemetry
+        if telemetry is not None:
+            telemetry.sources.extend(self.schedulers.values())
+
+        self.summarise = summarise or list
+
+        # Summaries of the canonical images, by name, kept for their
+        # duplicates. A canonical image still being analysed has a future
+        # instead, as a duplicate may be found in the meantime.
+        self.duplicates = duplicates
+        self.canonical_summaries = {}
+        self.canonical_pending = {}
+
+    # Add the image 'name' with perceptual hash 'image_hash', analysed by an
+    # earlier run, to the duplicate index, with its 'summary'.
+    def add_canonical(self, name, image_hash, summary):
+        self.duplicates.add(image_hash, name)
+        self.canonical_summaries[name] = summary
+
+    # Place the image at 'image_path' in the output directory as 'name' and
+    # return (summary of the response list of ImageProcessor.detect_all(),
+    # name of the image the summary is from, perceptual hash of the image or
+    # None without a duplicate index). The file is read once; its bytes are
+    # used for the output copy, sent to the APIs and decoded for the OpenCV
+    # metrics.
+    #
+    # 'previous' is resolved once the image before this one has been looked
+    # up in the duplicate index, 'indexed' once this one has.
+    async def process_image(self, image_path, name, previous=None,
+                            indexed=None):
+        start = time.perf_counter()
+        stats = ImageStats()
+        try:
+            loop = asyncio.get_event_loop()
+            with stats.timed('read'):
+                data = await loop.run_in_executor(self.io_executor,
+                                                  read_image, image_path)
+
+            # Rename file and place in output directory. This happens in the
+            # materialiser's own thread, alongside the analysis.
+            materialised = await loop.run_in_executor(
+                self.io_executor, self.materialiser.submit, image_path, name,
+                data)
+
+            result = await self._process_image(image_path, name, data, stats,
+                                               previous, indexed)
+
+            # The image is only handed back (and so journaled as done) once
+            # its output copy is written, so a resumed run never skips an
+            # image whose copy a crash lost
+            await asyncio.wrap_future(materialised)
+
+            return result
+        finally:
+            if indexed is not None and not indexed.done():
+                indexed.set_result(None)
+            if self.telemetry is not None:
+                self.telemetry.add(name, image_path, stats,
+                                   time.perf_counter() - start)
+
+    async def _process_image(self, image_path, name, data, stats, previous,
+                             indexed):
+        loop = asyncio.get_event_loop()
+        if self.duplicates is None:
+            response_list = await self._analyse(image_path, name, data,
+                                                stats)
+            return self.summarise(response_list), name, None
+
+        with stats.timed('dhash'):
+            image_hash = await loop.run_in_executor(self.io_executor, dhash,
+                                                    data)
+        if previous is not None:
+            await previous
+        canonical = None
+        if image_hash is not None:
+            canonical = self.duplicates.find(image_hash)
+            if canonical is None:
+                self.duplicates.add(image_hash, name)
+                self.canonical_pending[name] = loop.create_future()
+        if indexed is not None:
+            indexed.set_result(None)
+
+        if canonical is not None:
+            for provider in self.providers:
+                stats.count('reused.' + provider)
+            if canonical in self.canonical_summaries:
+                summary = self.canonical_summaries[canonical]
+            else:
+                summary = await asyncio.shield(
+                    self.canonical_pending[canonical])
+            return summary, canonical, image_hash
+
+        pending = self.canonical_pending.get(name)
+        try:
+            summary = self.summarise(await self._analyse(image_path, name,
+                                                         data, stats))
+        except Exception as error:
+            if pending is not None:
+                pending.set_exception(error)
+            raise
+        if pending is not None:
+            self.canonical_summaries[name] = summary
+            del self.canonical_pending[name]
+            pending.set_result(summary)
+
+        return summary, name, image_hash
+
+    async def _analyse(self, image_path, name, data, stats):
+        loop = asyncio.get_event_loop()
+
+        image_processor = ImageProcessor(
+            image_path, azure_url=self.azure_url, session=self.session,
+            batcher=self.batcher, cache=self.cache, data=data, stats=stats,
+            face_prefilter=self.face_prefilter, schedulers=self.schedulers,
+            **self.local_settings)
+
+        remote = []
+        for stage, method in REMOTE_STAGES:
+            if stage in self.providers:
+                remote.append(loop.run_in_executor(
+                    self.io_executor, getattr(image_processor, method)))
+            else:
+                remote.append(skipped(None))
+        if 'local' not in self.stages:
+            local = skipped([None] * len(LOCAL_METRICS))
+        elif self.local_executor is None:
+            local = loop.run_in_executor(self.local_threads,
+                                         image_processor.local_metrics)
+        else:
+            local = loop.run_in_executor(
+                self.local_executor,
+                functools.partial(local_features, image_path, data=data,
+                                  **self.local_settings))
+
+        responses = await asyncio.gather(*remote, local)
+        local_responses = responses[-1]
+        if 'local' in self.stages and self.local_executor is not None:
+            # The worker's timings come back with its results
+            local_responses, local_stats = local_responses
+            stats.merge(local_stats)
+
+        return list(responses[:-1]) + local_responses
+
+    # Analyse every job in 'jobs', an iterable of (item, image_path, name)
+    # tuples, and call 'on_result(item, summary, canonical, image_hash)' for
+    # each of them in the order of 'jobs' (see 'process_image()'). 'jobs' is
+    # consumed lazily, so it may be a generator.
+    def run(self, jobs, on_result):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self._run(jobs, on_result))
+        finally:
+            loop.close()
+
+    async def _run(self, jobs, on_result):
+        loop = asyncio.get_event_loop()
+        pending = collections.deque()
+        previous = None
+        try:
+            for item, image_path, name in jobs:
+                indexed = loop.create_future()
+                task = asyncio.ensure_future(self.process_image(
+                    image_path, name, previous, indexed))
+                pending.append((item, task))
+                previous = indexed
+
+                # Wait for the oldest image once too many are in flight
+                while len(pending) >= self.in_flight:
+                    item, task = pending.popleft()
+                    on_result(item, *(await task))
+
+            while pending:
+                item, task = pending.popleft()
+                on_result(item, *(await task))
+        finally:
+            # After a failure (e.g. a provider still failing after its
+            # retries) the other images in flight are given up, along with
+            # their requests still waiting for a provider
+            if pending:
+                for scheduler in self.schedulers.values():
+                    scheduler.close()
+            for item, task in pending:
+                task.cancel()
+            await asyncio.gather(*[task for item, task in pending],
+                                 return_exceptions=True)
+
+    def close(self):
+        self.io_executor.shutdown()
+        if self.local_threads is not None:
+            self.local_threads.shutdown()
+        if self.session is not None:
+            self.session.close()
+
+
+# Result of a stage left out of the run
+async def skipped(value):
+    return value
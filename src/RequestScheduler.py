@@ -0,0 +1,217 @@
+import email.utils
+import threading
+import random
+import time
+
+
+# HTTP status codes worth retrying: throttling and temporary server errors
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Names of the exceptions (from requests and the Google API client) raised
+# for network problems that are worth retrying
+TRANSIENT_ERRORS = {'ConnectionError', 'Timeout', 'ConnectTimeout',
+                    'ReadTimeout', 'ChunkedEncodingError', 'RetryError'}
+
+
+# HTTP status of a failed request: requests' HTTPError carries the response,
+# Google API errors their status as 'code'
+def error_status(error):
+    response = getattr(error, 'response', None)
+    if response is not None and hasattr(response, 'status_code'):
+        return response.status_code
+    code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+# True if the request that raised 'error' may succeed when sent again
+def is_transient(error):
+    if error_status(error) in TRANSIENT_STATUS:
+        return True
+
+    return type(error).__name__ in TRANSIENT_ERRORS
+
+
+# Seconds the server asked us to wait with a Retry-After header (a number of
+# seconds or an HTTP date), or None
+def retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+
+    return max(0.0, when.timestamp() - time.time())
+
+
+# This class is a token bucket: it holds up to 'burst' tokens and gains
+# 'rate' tokens per second. 'reserve(cost)' takes 'cost' tokens at once and
+# returns the seconds to wait before they are covered. A cost larger than
+# the tokens held (e.g. a Google batch of more images than 'burst') puts
+# the bucket into debt, which later requests wait for in turn, so over any
+# period of T seconds at most 'burst' + 'rate' * T tokens are used.
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+
+            return max(0.0, -self.tokens / self.rate)
+
+    # Block until 'cost' tokens are covered
+    def acquire(self, cost=1):
+        time.sleep(self.reserve(cost))
+
+
+# This class sends the requests of one provider (Google, Face or CV) from
+# any number of threads while keeping to the provider's quota:
+#
+#   - requests are spaced by a token bucket of 'rate' requests per second
+#     (no limit when 'rate' is None); 'cost' is the number of images in a
+#     request, as quotas count images
+#   - a transient failure (throttling, server error, network problem) is
+#     retried up to 'max_retries' times, after a jittered exponential
+#     backoff, or after the time given by a Retry-After header
+#   - a Retry-After answer pauses every request to the provider, not only
+#     the one that got it
+#   - after 'failure_threshold' failures in a row the circuit breaker opens
+#     and requests wait 'reset_timeout' seconds; then one request is let
+#     through to test the provider, and the breaker closes if it succeeds
+#
+# Requests block the calling thread while they wait, so the OpenCV work and
+# the other providers carry on. A request that still fails after its retries
+# (or fails with a non-transient error) raises the error. 'close()' makes
+# every waiting request give up with a RuntimeError, e.g. once the run has
+# failed.
+class RequestScheduler:
+    def __init__(self, provider, rate=None, burst=None, max_retries=5,
+                 base_delay=0.5, max_delay=60, failure_threshold=5,
+                 reset_timeout=30):
+        self.provider = provider
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.paused_until = 0
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+        self.closed = threading.Event()
+
+        # Counters of this provider, named as in ImageStats (see Telemetry)
+        self.counters = {}
+
+    def count(self, name):
+        with self.lock:
+            key = name + '.' + self.provider
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    # Wait until the provider may be sent a request. Returns True if the
+    # request is the one testing a provider whose breaker was open.
+    def _wait_for_turn(self):
+        while True:
+            if self.closed.is_set():
+                raise RuntimeError("Requests to {} were given up"
+                                   .format(self.provider))
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if self.open_until is not None:
+                    if now < self.open_until or self.probing:
+                        wait = max(wait, self.open_until - now, 0.1)
+                    elif wait <= 0:
+                        self.probing = True
+                        return True
+                if wait <= 0:
+                    return False
+            self.closed.wait(wait)
+
+    def _succeeded(self, probe):
+        with self.lock:
+            self.failures = 0
+            if probe:
+                self.probing = False
+                self.open_until = None
+
+    def _failed(self, probe, pause):
+        opened = False
+        with self.lock:
+            self.failures += 1
+            now = time.monotonic()
+            if pause is not None:
+                self.paused_until = max(self.paused_until, now + pause)
+            if probe:
+                # Still failing: stay open for another period
+                self.probing = False
+                self.open_until = now + self.reset_timeout
+            elif self.open_until is None and \
+                    self.failures >= self.failure_threshold:
+                self.open_until = now + self.reset_timeout
+                opened = True
+        if opened:
+            self.count('breaker_opens')
+
+    # Call 'function' (which sends one request) under the provider's rules
+    # and return its result.
+    def call(self, function, cost=1):
+        attempt = 0
+        while True:
+            probe = self._wait_for_turn()
+            if self.bucket is not None:
+                # Waiting for the tokens ends early once the run is given up
+                self.closed.wait(self.bucket.reserve(cost))
+                if self.closed.is_set():
+                    raise RuntimeError("Requests to {} were given up"
+                                       .format(self.provider))
+
+            try:
+                result = function()
+            except Exception as error:
+                if not is_transient(error):
+                    if probe:
+                        self._failed(probe, None)
+                    raise
+                pause = retry_after(error)
+                if error_status(error) == 429:
+                    self.count('throttled')
+                self._failed(probe, pause)
+
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.count('retries')
+                if pause is None:
+                    # Full jitter: anywhere up to the exponential backoff
+                    self.closed.wait(random.uniform(0, min(
+                        self.max_delay, self.base_delay * 2 ** attempt)))
+                continue
+
+            self._succeeded(probe)
+            return result
+
+    def close(self):
+        self.closed.set()
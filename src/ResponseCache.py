@@ -0,0 +1,129 @@
+import collections
+import threading
+import hashlib
+import sqlite3
+import time
+
+
+# This class stores responses from the Google/Microsoft APIs in an SQLite file
+# so that images whose bytes have not changed are not sent to the APIs again
+# on the next run. Entries are keyed by a hash of the image content together
+# with the provider, the features requested and the API version, so changing
+# any of those is a cache miss rather than a stale hit.
+#
+# The cache can be bounded by total size ('max_bytes', least recently used
+# entries are removed first) and by age ('max_age' in seconds). Hits and
+# misses are counted per provider.
+class ResponseCache:
+    # Check the size bound after this many new entries
+    EVICT_EVERY = 100
+
+    def __init__(self, path, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.puts = 0
+
+        # One connection is shared by the pipeline's threads, guarded by
+        # 'self.lock'
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, provider TEXT, value BLOB, "
+            "size INTEGER, created REAL, accessed REAL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed "
+            "ON responses (accessed)")
+        self.connection.commit()
+
+        self.evict()
+
+    # Hash identifying the content of an image
+    @staticmethod
+    def content_hash(content):
+        return hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def make_key(content_hash, provider, features, version):
+        return "{}:{}:{}:{}".format(content_hash, provider, features, version)
+
+    # Return the stored response (bytes) or None if there is none.
+    def get(self, content_hash, provider, features, version):
+        key = self.make_key(content_hash, provider, features, version)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, created FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is not None and self.max_age is not None and \
+                    now - row[1] > self.max_age:
+                row = None
+            if row is None:
+                self.misses[provider] += 1
+                return None
+
+            self.connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits[provider] += 1
+
+        return row[0]
+
+    # Store 'value' (bytes) as the response of 'provider' for the image.
+    def put(self, content_hash, provider, features, version, value):
+        key = self.make_key(content_hash, provider, features, version)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, provider, sqlite3.Binary(value), len(value), now, now))
+            self.connection.commit()
+            self.puts += 1
+            evict = self.puts % self.EVICT_EVERY == 0
+
+        if evict:
+            self.evict()
+
+    # Remove entries older than 'max_age', then the least recently used
+    # entries until the cache is no larger than 'max_bytes'.
+    def evict(self):
+        with self.lock:
+            if self.max_age is not None:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time.time() - self.max_age,))
+
+            if self.max_bytes is not None:
+                total = self.connection.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+                excess = total - self.max_bytes
+                if excess > 0:
+                    keys = []
+                    for key, size in self.connection.execute(
+                            "SELECT key, size FROM responses "
+                            "ORDER BY accessed"):
+                        keys.append((key,))
+                        excess -= size
+                        if excess <= 0:
+                            break
+                    self.connection.executemany(
+                        "DELETE FROM responses WHERE key = ?", keys)
+
+            self.connection.commit()
+
+    # Return a line summarising hits and misses per provider.
+    def summary(self):
+        providers = sorted(set(self.hits) | set(self.misses))
+        return ", ".join("{}: {} hits / {} misses".format(
+            provider, self.hits[provider], self.misses[provider])
+            for provider in providers)
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
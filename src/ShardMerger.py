@@ -0,0 +1,182 @@
+import json
+import os
+
+import pandas as pd
+
+from src.InputPlanner import shard_of
+from src.OutputWriter import FORMATS
+
+
+# Name of the file describing the shard a run processed, in its output
+# details path
+SHARD_FILE = 'shard.json'
+
+# Name of the report of rows whose image was not found (as written by
+# main.py)
+MISSING_FILE = 'missing.csv'
+
+
+# Write the description of the shard processed by a run to 'directory':
+# which shard it is, the number of shards, the number of rows in the whole
+# details CSV and the name of the output file.
+def write_shard_info(directory, shard, shards, rows, output_file):
+    with open(os.path.join(directory, SHARD_FILE), 'w') as info_file:
+        json.dump({'shard': shard, 'shards': shards, 'rows': rows,
+                   'output_file': output_file}, info_file)
+
+
+# Row number of an output 'file_name' ('ROW_NUMBER.jpg')
+def row_number(file_name):
+    return int(os.path.splitext(file_name)[0])
+
+
+# This class combines the output of the runs of every shard (see '--shard')
+# into the output of a single run. Each shard's output details path holds its
+# shard description, its output file and its report of missing images. The
+# merged output has the same columns, with rows in row number order, so it is
+# the file one machine would have written.
+#
+# 'check()' makes sure the shards fit together before anything is written:
+# every shard of the same split is there exactly once, no row is in two
+# places, every row of the details CSV is either in an output file or in a
+# missing report, and every row is in the shard its short-code hashes to.
+class ShardMerger:
+    def __init__(self, directories, output_file=None):
+        self.directories = directories
+        self.infos = []
+        for directory in directories:
+            with open(os.path.join(directory, SHARD_FILE)) as info_file:
+                self.infos.append(json.load(info_file))
+
+        # Unless told otherwise, shards are merged to the format they were
+        # written in
+        self.output_file = output_file or self.infos[0]['output_file']
+        self.format = FORMATS.get(
+            os.path.splitext(self.output_file)[1].lower())
+
+        self.details = None
+        self.missing = None
+
+    # Read the output file and missing report of every shard. CSV values are
+    # kept as the text they were written as, so the merged file has exactly
+    # the same layout.
+    def load(self):
+        details = []
+        missing = []
+        for directory, info in zip(self.directories, self.infos):
+            path = os.path.join(directory, info['output_file'])
+            file_format = FORMATS.get(os.path.splitext(path)[1].lower())
+            if file_format != self.format:
+                raise ValueError("Shard output {} is not {}".format(
+                    path, self.format))
+
+            if self.format == 'csv':
+                frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+            else:
+                frame = self._read_arrow(path)
+            frame['shard'] = info['shard']
+            details.append(frame)
+
+            frame = pd.read_csv(os.path.join(directory, MISSING_FILE),
+                                dtype={'short_code': str},
+                                keep_default_na=False)
+            frame['shard'] = info['shard']
+            missing.append(frame)
+
+        self.details = pd.concat(details, ignore_index=True)
+        self.details['row'] = self.details['file_name'].map(row_number)
+        self.missing = pd.concat(missing, ignore_index=True)
+
+    # Return the list of problems that keep the shards from being merged
+    def check(self):
+        problems = []
+
+        splits = set((info['shards'], info['rows']) for info in self.infos)
+        if len(splits) > 1:
+            problems.append("Shards come from different splits or details "
+                            "files: {}".format(sorted(splits)))
+            return problems
+        shards, rows = splits.pop()
+
+        numbers = [info['shard'] for info in self.infos]
+        for shard in sorted(set(numbers)):
+            if numbers.count(shard) > 1:
+                problems.append("Shard {} given {} times".format(
+                    shard, numbers.count(shard)))
+        for shard in range(shards):
+            if shard not in numbers:
+                problems.append("Shard {} of {} is missing".format(shard,
+                                                                   shards))
+
+        if self.details is None:
+            self.load()
+
+        # Every row is either analysed or missing, once
+        found = pd.concat([self.details['row'], self.missing['index']])
+        counts = found.value_counts()
+        for row in sorted(counts[counts > 1].index):
+            problems.append("Row {} appears {} times".format(
+                row, counts[row]))
+        gaps = sorted(set(range(rows)) - set(found))
+        if gaps:
+            problems.append("{} rows in no shard, e.g. {}".format(
+                len(gaps), gaps[:10]))
+
+        # Every row is in the shard its short-code belongs to
+        for frame in (self.details, self.missing):
+            misplaced = frame[frame['short_code'].map(
+                lambda short_code: shard_of(short_code, shards)) !=
+                frame['shard']]
+            for short_code, shard in zip(misplaced['short_code'],
+                                         misplaced['shard']):
+                problems.append("{} is in shard {} but belongs to shard {}"
+                                .format(short_code, shard,
+                                        shard_of(short_code, shards)))
+
+        return problems
+
+    # Write the merged output file and missing report to 'directory'
+    def write(self, directory):
+        if self.details is None:
+            self.load()
+
+        details = self.details.sort_values('row', kind='mergesort').drop(
+            columns=['shard', 'row'])
+        path = os.path.join(directory, self.output_file)
+        if self.format == 'csv':
+            # Written the way OutputWriter writes it
+            with open(path, 'w', newline='') as handle:
+                details.to_csv(handle, index=None)
+        else:
+            self._write_arrow(path, details)
+
+        missing = self.missing.sort_values('index', kind='mergesort').drop(
+            columns='shard').set_index('index')
+        missing.to_csv(os.path.join(directory, MISSING_FILE),
+                       index_label='index')
+
+        return path
+
+    # Parquet and Feather files are read and written with pyarrow, as
+    # OutputWriter does
+    def _read_arrow(self, path):
+        import pyarrow as pa
+
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(path).to_pandas()
+
+        with pa.memory_map(path) as source:
+            return pa.ipc.open_file(source).read_pandas()
+
+    def _write_arrow(self, path, frame):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
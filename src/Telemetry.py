@@ -0,0 +1,226 @@
+import contextlib
+import threading
+import heapq
+import json
+import time
+import os
+
+
+# Prefix of the Prometheus metric names written by Telemetry
+PROMETHEUS_PREFIX = 'instagram'
+
+# Stages whose time is spent on the OpenCV side of an image (decoding, the
+# gray/HSV/etc. conversions and the metrics), as opposed to waiting for the
+# APIs. The slowest images by this time are the ones '--profile' looks at.
+LOCAL_STAGES = ('decode', 'convert.', 'metric.')
+
+# Prometheus label holding the second half of 'event.label' counter names.
+# Errors are counted per stage, everything else per provider.
+COUNTER_LABELS = {'errors': 'stage'}
+
+
+# This class records where the time of one image goes. 'timed(stage)' adds
+# the duration of a block to the time of 'stage' and, if the block raises,
+# counts an error of that stage; 'count(name)' adds to a counter. Counter
+# names are 'event.label', e.g. 'cache_hits.google'.
+#
+# The API requests and the OpenCV metrics of an image run in different
+# threads that record into the same ImageStats, so updates hold a lock. The
+# lock is left out when an ImageStats is pickled, so a worker process can
+# still send one back with its results.
+class ImageStats:
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'timings': self.timings, 'counters': self.counters}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count('errors.' + stage)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Add the timings and counters of 'other' (e.g. from a worker process)
+    def merge(self, other):
+        with self.lock:
+            for stage, seconds in other.timings.items():
+                self.timings[stage] = self.timings.get(stage, 0) + seconds
+            for name, amount in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Seconds spent in LOCAL_STAGES
+    def local_seconds(self):
+        return sum(seconds for stage, seconds in self.timings.items()
+                   if stage.startswith(LOCAL_STAGES))
+
+
+# This class collects the ImageStats of every image of a run. It keeps, per
+# stage, the number of images, the total and the largest time, and the total
+# of every counter. Every 'interval' seconds it prints a progress line and,
+# if 'summary_path' is given, rewrites a summary there: a Prometheus textfile
+# (for node_exporter's textfile collector) if the name ends in '.prom' and
+# JSON otherwise. With 'log_path' every image is also written as one line of
+# JSON to a log file. The 'keep_slowest' images with the most local time are
+# remembered for profiling (see 'slowest()').
+#
+# 'sources' are objects with counters of their own that are not tied to one
+# image (e.g. the retries of a RequestScheduler); their 'counters' dicts are
+# added to the totals whenever a summary is made.
+class Telemetry:
+    def __init__(self, log_path=None, summary_path=None, interval=30,
+                 keep_slowest=0, sources=()):
+        self.summary_path = summary_path
+        self.sources = list(sources)
+        self.interval = interval
+        self.keep_slowest = keep_slowest
+
+        # {stage: [images, total seconds, largest seconds]}
+        self.stages = {}
+        self.counters = {}
+        self.images = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+        # Heap of (local seconds, name, path) of the slowest images
+        self.slowest_images = []
+
+        self.log = open(log_path, 'w') if log_path else None
+
+    # Record the ImageStats of the image 'name' read from 'path', which took
+    # 'seconds' from start to finish.
+    def add(self, name, path, stats, seconds):
+        self.images += 1
+        for stage, stage_seconds in list(stats.timings.items()) + \
+                [('image', seconds)]:
+            entry = self.stages.setdefault(stage, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += stage_seconds
+            entry[2] = max(entry[2], stage_seconds)
+        for counter, amount in stats.counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+        if self.log is not None:
+            self.log.write(json.dumps({
+                'time': time.time(), 'image': name, 'path': path,
+                'seconds': seconds, 'stages': stats.timings,
+                'counters': stats.counters}) + "\n")
+
+        if self.keep_slowest:
+            entry = (stats.local_seconds(), name, path)
+            if len(self.slowest_images) < self.keep_slowest:
+                heapq.heappush(self.slowest_images, entry)
+            else:
+                heapq.heappushpop(self.slowest_images, entry)
+
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    # (local seconds, name, path) of the slowest images, slowest first
+    def slowest(self):
+        return sorted(self.slowest_images, reverse=True)
+
+    # Images per second since the start of the run
+    def rate(self):
+        return self.images / max(time.time() - self.start, 1e-9)
+
+    # Totals of the counters of every image and of every source
+    def totals(self):
+        totals = dict(self.counters)
+        for source in self.sources:
+            for counter, amount in list(source.counters.items()):
+                totals[counter] = totals.get(counter, 0) + amount
+
+        return totals
+
+    def summary(self):
+        return {'time': time.time(),
+                'images': self.images,
+                'images_per_second': self.rate(),
+                'stages': {stage: {'images': images, 'seconds': total,
+                                   'mean_seconds': total / images,
+                                   'max_seconds': largest}
+                           for stage, (images, total, largest)
+                           in sorted(self.stages.items())},
+                'counters': dict(sorted(self.totals().items()))}
+
+    # Summary in the Prometheus text exposition format
+    def prometheus(self):
+        name = PROMETHEUS_PREFIX + '_stage_seconds'
+        lines = ["# HELP {} Time spent in each stage of the analysis"
+                 .format(name),
+                 "# TYPE {} summary".format(name)]
+        for stage, (images, total, largest) in sorted(self.stages.items()):
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage,
+                                                            images))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, total))
+        name = PROMETHEUS_PREFIX + '_stage_max_seconds'
+        lines.append("# TYPE {} gauge".format(name))
+        for stage, (images, total, largest) in sorted(self.stages.items()):
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage, largest))
+
+        lines.append("# TYPE {}_images_total counter".format(
+            PROMETHEUS_PREFIX))
+        lines.append("{}_images_total {}".format(PROMETHEUS_PREFIX,
+                                                 self.images))
+        lines.append("# TYPE {}_images_per_second gauge".format(
+            PROMETHEUS_PREFIX))
+        lines.append("{}_images_per_second {}".format(PROMETHEUS_PREFIX,
+                                                      self.rate()))
+
+        # 'event.label' counters become '<prefix>_event_total{provider=label}'
+        events = {}
+        for counter, amount in self.totals().items():
+            event, _, label = counter.partition('.')
+            events.setdefault(event, []).append((label, amount))
+        for event, values in sorted(events.items()):
+            name = "{}_{}_total".format(PROMETHEUS_PREFIX, event)
+            lines.append("# TYPE {} counter".format(name))
+            key = COUNTER_LABELS.get(event, 'provider')
+            for label, amount in sorted(values):
+                lines.append('{}{{{}="{}"}} {}'.format(name, key, label,
+                                                       amount))
+
+        return "\n".join(lines) + "\n"
+
+    # Print a progress line and rewrite the summary file
+    def report(self):
+        self.last_report = time.time()
+        print("Progress: {} images, {:.2f} images/sec".format(
+            self.images, self.rate()))
+        if self.summary_path is None:
+            return
+
+        if self.summary_path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2) + "\n"
+
+        # Readers (e.g. node_exporter) never see a half written file
+        temporary = self.summary_path + '.tmp'
+        with open(temporary, 'w') as summary_file:
+            summary_file.write(text)
+        os.replace(temporary, self.summary_path)
+
+    # Write the final summary
+    def close(self):
+        self.report()
+        if self.log is not None:
+            self.log.close()
@@ -1,4 +1,5 @@
 import optparse
+import sys
 import os
 
 
@@ -14,19 +15,193 @@ class Utilities:
                               help="path to details CSV file")
         tmp_parser.add_option("-l", "--labels", dest="labels", type="string",
                               help="path to labels CSV file")
+        tmp_parser.add_option("--label_index", dest="label_index",
+                              type="string",
+                              help="file holding the index of the labels "
+                                   "CSV, built on first use (by default "
+                                   "in the output details path)")
         tmp_parser.add_option("-i", "--image_dir", dest="image_dir", type="string",
                               help="name of directory holding images")
         tmp_parser.add_option("-a", "--new_details", dest="new_details",
                               type="string", help="output details path")
         tmp_parser.add_option("-b", "--new_image_dir", dest="new_image_dir",
                               type="string", help="output image directory")
+        tmp_parser.add_option("-w", "--workers", dest="workers", type="int",
+                              help="number of processes computing the OpenCV "
+                                   "metrics (0 computes them in-process)")
+        tmp_parser.add_option("-n", "--in_flight", dest="in_flight",
+                              type="int", help="number of images analysed at "
+                                               "the same time; their Google "
+                                               "requests are sent together, "
+                                               "up to 16 per batch (default "
+                                               "16, or 2 per worker if more)")
+        tmp_parser.add_option("-u", "--azure_url", dest="azure_url",
+                              type="string", help="base URL of the Microsoft "
+                                                  "Azure APIs")
+        tmp_parser.add_option("-c", "--cache", dest="cache", type="string",
+                              help="SQLite file caching API responses "
+                                   "between runs")
+        tmp_parser.add_option("--cache_max_mb", dest="cache_max_mb",
+                              type="float", help="maximum size of the "
+                                                 "response cache in MB")
+        tmp_parser.add_option("--cache_max_days", dest="cache_max_days",
+                              type="float", help="age in days after which "
+                                                 "cached responses expire")
+        tmp_parser.add_option("-o", "--output_file", dest="output_file",
+                              type="string", help="name of the output file "
+                                                  "in the output details "
+                                                  "path (.csv, .parquet or "
+                                                  ".feather)")
+        tmp_parser.add_option("--chunk_rows", dest="chunk_rows", type="int",
+                              help="number of rows written to the output "
+                                   "file at a time")
+        tmp_parser.add_option("-r", "--resume", dest="resume",
+                              action="store_true",
+                              help="skip images finished by a previous run "
+                                   "(read from its journal)")
+        tmp_parser.add_option("--smooth_window", dest="smooth_window",
+                              type="int", help="size of the neighbourhood "
+                                               "used by the smoothness "
+                                               "metric")
+        tmp_parser.add_option("--proxy_scale", dest="proxy_scale", type="int",
+                              help="compute the global OpenCV metrics on "
+                                   "the image decoded at 1/2, 1/4 or 1/8 of "
+                                   "its size (1 uses the full image)")
+        tmp_parser.add_option("-m", "--materialise", dest="materialise",
+                              type="choice",
+                              choices=['copy', 'hardlink', 'symlink',
+                                       'reflink', 'manifest'],
+                              help="how renamed images are placed in the "
+                                   "output image directory: copy, hardlink, "
+                                   "symlink, reflink or manifest (no files, "
+                                   "only the list in images.csv)")
+        tmp_parser.add_option("--verify", dest="verify", type="choice",
+                              choices=['none', 'size', 'hash'],
+                              help="check the output images against the "
+                                   "manifest at the end of the run: none, "
+                                   "size or hash")
+        tmp_parser.add_option("--log_file", dest="log_file", type="string",
+                              help="file to log the timings of every image "
+                                   "to, one line of JSON per image")
+        tmp_parser.add_option("--stats_file", dest="stats_file",
+                              type="string",
+                              help="file the run's timings and counters are "
+                                   "written to periodically: a Prometheus "
+                                   "textfile if it ends in .prom, JSON "
+                                   "otherwise")
+        tmp_parser.add_option("--stats_interval", dest="stats_interval",
+                              type="float", help="seconds between progress "
+                                                 "reports")
+        tmp_parser.add_option("--profile", dest="profile", type="int",
+                              help="profile the OpenCV work of this many of "
+                                   "the slowest images at the end of the "
+                                   "run")
+        tmp_parser.add_option("--shard", dest="shard", type="string",
+                              help="process only shard K of N (0 <= K < "
+                                   "N), given as K/N; the outputs of all "
+                                   "shards are combined with merge.py")
+        tmp_parser.add_option("--face_prefilter", dest="face_prefilter",
+                              action="store_true",
+                              help="skip the Face API for images a local "
+                                   "OpenCV face detector finds no face in")
+        tmp_parser.add_option("--face_threshold", dest="face_threshold",
+                              type="float",
+                              help="score a local face detection needs to "
+                                   "send the image to the Face API; lower "
+                                   "misses fewer faces (see face_report.py)")
+        tmp_parser.add_option("--face_model", dest="face_model",
+                              type="string",
+                              help="YuNet ONNX model for the local face "
+                                   "detector (the Haar cascade shipped with "
+                                   "OpenCV is used otherwise)")
+        tmp_parser.add_option("--dedup", dest="dedup", action="store_true",
+                              help="reuse the analysis of an earlier image "
+                                   "for images that look the same "
+                                   "(perceptual hash)")
+        tmp_parser.add_option("--dedup_distance", dest="dedup_distance",
+                              type="int", help="number of the 64 hash bits "
+                                               "in which duplicates may "
+                                               "differ")
+        tmp_parser.add_option("--google_rate", dest="google_rate",
+                              type="float",
+                              help="images per second sent to the Google "
+                                   "Vision API (no limit by default)")
+        tmp_parser.add_option("--face_rate", dest="face_rate", type="float",
+                              help="requests per second sent to the Face "
+                                   "API (no limit by default)")
+        tmp_parser.add_option("--cv_rate", dest="cv_rate", type="float",
+                              help="requests per second sent to the "
+                                   "Computer Vision API (no limit by "
+                                   "default)")
+        tmp_parser.add_option("--max_retries", dest="max_retries",
+                              type="int",
+                              help="times a throttled or failed request is "
+                                   "sent again before the run stops")
+        tmp_parser.add_option("--azure_colours", dest="azure_colours",
+                              action="store_true",
+                              help="take the dominant colours from the "
+                                   "Microsoft Computer Vision API instead "
+                                   "of computing them locally; the local "
+                                   "ones do not always agree with the API "
+                                   "(see colour_report.py)")
+        tmp_parser.add_option("--stages", dest="stages", type="string",
+                              help="comma separated stages to run, of "
+                                   "google, face, cv and local; the "
+                                   "columns of the others are left empty")
+        tmp_parser.add_option("--local_only", dest="local_only",
+                              action="store_true",
+                              help="only compute the OpenCV metrics; no "
+                                   "API is called and no key.json is "
+                                   "needed (same as '--stages local')")
         tmp_parser.set_defaults(details="2526_details/details.csv",
                                 labels="2526_details/labels.csv",
                                 image_dir="2526_images/", new_details="output/",
-                                new_image_dir="output/images")
+                                new_image_dir="output/images", workers=0,
+                                in_flight=None, azure_url=None, cache=None,
+                                cache_max_mb=None, cache_max_days=None,
+                                output_file="details.csv", chunk_rows=500,
+                                resume=False, smooth_window=3,
+                                proxy_scale=1, materialise='copy',
+                                verify='size', log_file=None,
+                                stats_file=None, stats_interval=30,
+                                profile=0, shard="0/1", face_prefilter=False,
+                                face_threshold=None, face_model=None,
+                                label_index=None, dedup=False,
+                                dedup_distance=4, google_rate=None,
+                                face_rate=None, cv_rate=None,
+                                max_retries=5, azure_colours=False,
+                                stages="google,face,local",
+                                local_only=False)
 
         return tmp_parser.parse_args()
 
+    # Return (K, N) of a '--shard K/N' value.
+    @staticmethod
+    def parse_shard(value):
+        try:
+            shard, shards = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise ValueError("Shard must be given as K/N, not {}"
+                             .format(value))
+        if not 0 <= shard < shards:
+            raise ValueError("Shard must be between 0/{0} and {1}/{0}, not "
+                             "{2}".format(shards, shards - 1, value))
+
+        return shard, shards
+
+    # Return the list of stages of a '--stages' value, checked against the
+    # 'known' stages.
+    @staticmethod
+    def parse_stages(value, known):
+        stages = [stage.strip() for stage in value.split(",")
+                  if stage.strip()]
+        for stage in stages:
+            if stage not in known:
+                raise ValueError("Unknown stage {}, must be one of {}"
+                                 .format(stage, ", ".join(known)))
+
+        return stages
+
     # Make sure output directories exists before program runs.
     @staticmethod
     def create_directories(detail_dir, image_dir):
@@ -34,3 +209,20 @@ class Utilities:
             os.makedirs(detail_dir)
         if not os.path.exists(image_dir):
             os.makedirs(image_dir)
+
+    # Return the peak memory use, in MB, of this process and of the largest
+    # of its child processes (e.g. OpenCV workers) that have finished, or
+    # (None, None) where it is not reported (Windows has no 'resource').
+    @staticmethod
+    def peak_memory():
+        try:
+            import resource
+        except ImportError:
+            return None, None
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        return own / unit, children / unit
@@ -0,0 +1,132 @@
+import concurrent.futures
+import threading
+
+from src.RequestScheduler import is_transient
+
+
+# Google accepts at most this many images in one batch_annotate_images call,
+# and at most this many bytes of image content in one request.
+GOOGLE_BATCH_LIMIT = 16
+GOOGLE_BATCH_BYTES = 10 * 1024 * 1024
+
+
+# Error of the AnnotateImageResponse 'response' as a Google API exception
+# (whose 'code' is the matching HTTP status), or None if it succeeded. The
+# error of a single image is given in its response rather than raised.
+def response_error(response):
+    if not response.error.code:
+        return None
+
+    from google.api_core import exceptions
+    return exceptions.from_grpc_status(response.error.code,
+                                       response.error.message)
+
+
+# This class collects AnnotateImageRequests made by many threads (one per
+# image being analysed) and sends them to Google in a single
+# batch_annotate_images call. A batch is sent as soon as it holds 'max_batch'
+# requests, or 'max_wait' seconds after its first request arrived, whichever
+# comes first. Each caller gets back the AnnotateImageResponse for its own
+# image, or has the error of its image raised. A transient error of any
+# image is raised in the 'scheduler', so the batch is sent again.
+class VisionBatcher:
+    def __init__(self, get_client, max_batch=GOOGLE_BATCH_LIMIT,
+                 max_wait=0.05, scheduler=None):
+        # 'get_client' returns the (shared) Vision client. It is only called
+        # when a batch is sent, so credentials are not needed before that.
+        self.get_client = get_client
+
+        # Optional RequestScheduler keeping the batches within the quota
+        self.scheduler = scheduler
+        self.max_batch = max(1, min(max_batch, GOOGLE_BATCH_LIMIT))
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.timer = None
+
+    # Send 'request' as part of a batch and return its AnnotateImageResponse.
+    # Blocks until the batch it belongs to has been answered.
+    def annotate(self, request):
+        future = concurrent.futures.Future()
+        size = len(request.image.content)
+
+        batches = []
+        with self.lock:
+            # A request that would push the batch over the byte limit starts
+            # a new one
+            if self.pending and \
+                    self.pending_bytes + size > GOOGLE_BATCH_BYTES:
+                batches.append(self._take())
+
+            self.pending.append((request, future))
+            self.pending_bytes += size
+
+            if len(self.pending) >= self.max_batch:
+                batches.append(self._take())
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        for batch in batches:
+            self._send(batch)
+
+        return future.result()
+
+    # Send whatever requests are waiting, without waiting for a full batch.
+    def flush(self):
+        with self.lock:
+            batch = self._take()
+        self._send(batch)
+
+    # Remove and return the waiting requests. Must hold 'self.lock'.
+    def _take(self):
+        batch = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        return batch
+
+    # Make one batch_annotate_images call and hand every response (or the
+    # error) back to the thread waiting for it.
+    def _send(self, batch):
+        if not batch:
+            return
+
+        def annotate():
+            response = self.get_client().batch_annotate_images(
+                [request for request, _ in batch])
+            for image_response in response.responses:
+                error = response_error(image_response)
+                if error is not None and is_transient(error):
+                    raise error
+            return response
+
+        try:
+            if self.scheduler is None:
+                response = annotate()
+            else:
+                response = self.scheduler.call(annotate, cost=len(batch))
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+
+        for (_, future), image_response in zip(batch, response.responses):
+            error = response_error(image_response)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(image_response)
+
+        # Requests left without a response would keep their threads waiting
+        # for ever
+        if len(response.responses) != len(batch):
+            error = RuntimeError("Google answered {} of {} images in a batch"
+                                 .format(len(response.responses), len(batch)))
+            for _, future in batch[len(response.responses):]:
+                future.set_exception(error)